@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+#
+# Batch tracing of many bitmaps with the centerline-trace pipeline, without inkscape.
+# (C) 2016-2019 juewei@fabmail.org and contributors.
+# Distribute under GPL-2.0 or ask.
+#
+# Usage:
+#   python centerline-batch.py [options] FILE|DIRECTORY|GLOB ...
+#
+# All options of centerline-trace.py are accepted, e.g. --candidates=15 --backend=python
+# Images are traced in parallel, one per process (--processes, -P). One svg file per input image
+# is written to --output-dir, or next to the image. If images of different directories have the
+# same name, their paths relative to the common directory of all images are kept under --output-dir.
+# Images that would still write the same svg file, e.g. a.png and a.jpg, are refused before
+# anything is traced. A timing summary is printed at the end.
+#
+# Unlike centerline-trace.sh, no wrapper svg document is written or parsed.
+#
+
+import sys, os, glob, time, imp, multiprocessing
+
+image_suffixes = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff', '.pbm', '.pgm', '.ppm', '.webp')
+
+centerline_trace = imp.load_source('centerline_trace', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'centerline-trace.py'))
+import simplestyle              # found through the inkscape extension path, that centerline-trace.py adds.
+from PIL import Image
+from xml.sax.saxutils import quoteattr
+
+tracer = None           # the TraceCenterline instance of this process.
+
+
+def expand_inputs(args):
+  """ a sorted list of image files from files, directories and glob patterns. """
+  files = []
+  for a in args:
+    if os.path.isdir(a):
+      for name in sorted(os.listdir(a)):
+        if name.lower().endswith(image_suffixes):
+          files.append(os.path.join(a, name))
+    elif os.path.exists(a):
+      files.append(a)
+    else:
+      matches = sorted(glob.glob(a))
+      if not matches:
+        print >>sys.stderr, "Warning: no such file: " + a
+      files.extend(matches)
+  seen = set()
+  return [ f for f in files if not (f in seen or seen.add(f)) ]
+
+
+def output_names(files, outdir=None):
+  """ the svg file of each image file, next to the image or in outdir. Returns (names, clashes), where names
+      is a dict of image file -> svg file, and clashes a list of lists of image files that write the same svg file.
+  """
+  def svg(path):
+    return os.path.splitext(path)[0] + '.svg'
+  if outdir is None:
+    names = dict([ (f, svg(f)) for f in files ])
+  else:
+    names = dict([ (f, os.path.join(outdir, svg(os.path.basename(f)))) for f in files ])
+    if len(set(names.values())) < len(names):
+      # the same name in different directories: keep the paths below the common directory.
+      dirs = [ os.path.dirname(os.path.abspath(f)) + os.sep for f in files ]
+      top = os.path.dirname(os.path.commonprefix(dirs))
+      names = dict([ (f, os.path.join(outdir, svg(os.path.relpath(os.path.abspath(f), top)))) for f in files ])
+  writers = {}
+  for f in files:
+    writers.setdefault(os.path.normcase(os.path.abspath(names[f])), []).append(f)
+  clashes = [ fs for fs in writers.values() if len(fs) > 1 ]
+  return (names, clashes)
+
+
+def svg_document(path_d, stroke_width, im_size, orig_size):
+  """ a standalone svg document, sized like the image in pixels. """
+  px_per_unit = orig_size[0] / float(im_size[0])
+  if tracer.hairline:
+    stroke_width = tracer.hairline_width * 96. / 25.4 / px_per_unit   # mm2px FIXME: 96dpi is just a default guess.
+  style = { 'stroke': '#000000', 'fill': 'none', 'stroke-linecap': 'round', 'stroke-width': stroke_width }
+  if tracer.invert_image: style['stroke'] = '#777777'
+  return ('<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n' +
+          '<svg xmlns="http://www.w3.org/2000/svg" width="%dpx" height="%dpx" viewBox="0 0 %g %g">\n' % (orig_size[0], orig_size[1], im_size[0], im_size[1]) +
+          '  <path style=%s d=%s/>\n' % (quoteattr(simplestyle.formatStyle(style)), quoteattr(path_d)) +
+          '</svg>\n')
+
+
+def trace_file(job):
+  """ trace one image and write its svg. Runs in a worker process. job is a tuple (image_file, svg_file).
+      Returns (image_file, svg_file, seconds, error message or None, timing spans).
+  """
+  res = trace_file_svg(*job)
+  return res + (tracer.timing.pop_events(),)
+
+
+def trace_file_svg(image_file, svg_file):
+  t0 = time.time()
+  try:
+    im = Image.open(image_file)         # reads only the header, the pixels are decoded by the trace.
+    orig_size = im.size
+    im.close()
+    with tracer.timing.span('image', file=image_file):
+      path_d,stroke_width,im_size = tracer.svg_centerline_trace(image_file)
+    if not path_d:
+      return (image_file, None, time.time() - t0, "Couldn't trace the path. Check --invert and the contrast of the image.")
+    fp = open(svg_file, 'w')
+    fp.write(svg_document(tracer.postprocess_path(path_d), stroke_width, im_size, orig_size))
+    fp.close()
+  except Exception as e:
+    return (image_file, None, time.time() - t0, "%s: %s" % (e.__class__.__name__, e))
+  return (image_file, svg_file, time.time() - t0, None)
+
+
+def make_tracer(argv):
+  """ a TraceCenterline instance with the options from argv. Returns (tracer, args). """
+  t = centerline_trace.TraceCenterline()
+  t.OptionParser.usage = "%prog [options] FILE|DIRECTORY|GLOB ..."
+  t.OptionParser.add_option('-o', '--output-dir', action='store',
+        type='string', default=None, help="Write svg files here. (Default: next to each image)")
+  t.options, args = t.OptionParser.parse_args(argv)
+  return (t, args)
+
+
+def init_worker(argv, workers):
+  global tracer
+  tracer,args = make_tracer(argv)
+  tracer.options.workers = workers
+  tracer.apply_options()
+
+
+def main(argv):
+  global tracer
+  tracer,args = make_tracer(argv)
+  if tracer.options.version:
+    print centerline_trace.__version__
+    return 0
+  tracer.apply_options()
+  files = expand_inputs(args)
+  if not files:
+    tracer.OptionParser.print_help()
+    return 1
+  names, clashes = output_names(files, tracer.options.output_dir)
+  if clashes:
+    for fs in clashes:
+      print >>sys.stderr, "Error: %s would write the same svg file %s" % (', '.join(fs), names[fs[0]])
+    return 1
+  for d in sorted(set([ os.path.dirname(n) for n in names.values() ])):
+    if d and not os.path.isdir(d):
+      os.makedirs(d)
+
+  processes = tracer.options.processes
+  if processes < 1:
+    processes = multiprocessing.cpu_count()
+  processes = min(processes, len(files))
+  workers = tracer.options.workers
+  if workers < 1:
+    # share the CPUs between the processes and their candidate runs.
+    workers = max(1, multiprocessing.cpu_count() // processes)
+
+  t0 = time.time()
+  results = []
+  failed = 0
+  if processes > 1:
+    pool = multiprocessing.Pool(processes, init_worker, (argv, workers))
+    jobs = pool.imap_unordered(trace_file, [ (f, names[f]) for f in files ])
+  else:
+    pool = None
+    init_worker(argv, workers)
+    jobs = (trace_file((f, names[f])) for f in files)
+  for image_file, svg_file, seconds, err, events in jobs:
+    results.append((image_file, svg_file, seconds, err))
+    tracer.timing.extend(events)
+    if err is not None:
+      failed += 1
+      print >>sys.stderr, "%s: ERROR: %s" % (image_file, err)
+    else:
+      print "%8.2fs  %s -> %s" % (seconds, image_file, svg_file)
+    sys.stdout.flush()
+  if pool is not None:
+    pool.close()
+    pool.join()
+
+  wall = time.time() - t0
+  busy = sum([ r[2] for r in results ])
+  print "%d images, %d failed, %.2fs wall time, %.2fs trace time, %.2fs per image, %d processes" % (
+        len(results), failed, wall, busy, busy / max(len(results), 1), processes)
+  if tracer.timing.enabled:
+    tracer.timing.add('batch', t0, wall, { 'images': len(results), 'processes': processes })
+    tracer.write_timing()
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -66,16 +66,42 @@
 __version__ = '0.8d'	# Keep in sync with centerline-trace.inx ca. line 3 and 24
 __author__ = 'Juergen Weigert <juergen@fabmail.org>'
 
-import sys, os, re, math, tempfile, subprocess, base64, time
-
+import sys, os
+if __name__ == '__main__' and ('-V' in sys.argv[1:] or '--version' in sys.argv[1:]):
+  print __version__             # without waiting for the imports below.
+  sys.exit(0)
+
+import re, math, string, tempfile, subprocess, binascii, io, time, shutil, hashlib, json, threading, signal, errno
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 try:
-  from PIL import Image
-  from PIL import ImageOps
-  from PIL import ImageStat
-  from PIL import ImageFilter
-except:
-  print >>sys.stderr, "Error: Cannot import PIL. Try\n  apt-get install python-pil"
-  sys.exit(1)
+  import resource               # not on windows.
+except ImportError:
+  resource = None
+
+# PIL and numpy take longer to import than all the rest together.
+# They are imported by lazy_imports() when the first image is traced.
+Image = ImageOps = ImageStat = ImageFilter = None
+numpy = None
+lazy_imports_done = False
+
+def lazy_imports():
+  global Image, ImageOps, ImageStat, ImageFilter, numpy, lazy_imports_done
+  if lazy_imports_done:
+    return
+  try:
+    from PIL import Image
+    from PIL import ImageOps
+    from PIL import ImageStat
+    from PIL import ImageFilter
+  except:
+    print >>sys.stderr, "Error: Cannot import PIL. Try\n  apt-get install python-pil"
+    sys.exit(1)
+  try:
+    import numpy
+  except ImportError:
+    numpy = None                # optional, we fall back to slower code.
+  lazy_imports_done = True
 
 
 debug = False
@@ -100,9 +126,12 @@ else:   				# linux
   # if sys_platform.startswith('linux'):
   sys.path.append('/usr/share/inkscape/extensions')
 
-# inkscape libraries
-import inkex, simplestyle
-import cubicsuperpath
+# inkscape libraries. inkex cannot be imported lazily: TraceCenterline is an inkex.Effect, and its option
+# parser decides whether there is anything to trace. simplestyle is imported when a path is written.
+import inkex
+
+import centerline_paths
+import centerline_timing
 
 try:
   # only since inkscape 0.91
@@ -118,6 +147,518 @@ def uutounit(self,nn,uu):
   except:
     return inkex.uutounit(nn,uu)	# inkscape 0.48
 
+def svg_path_d(svg):
+  """ the d attributes of all paths in svg text as returned by a backend, joined into one path.
+      Returns None, if svg is not proper xml.
+  """
+  try:
+    xml = inkex.etree.fromstring(svg)
+  except:
+    return None
+  return ''.join([ p.attrib['d'] for p in xml.findall('path') ])
+
+def svg_pathstats(path_d):
+  """ calculate statistics from an svg path:
+      length (measuring bezier splines as straight lines through the handles).
+      points (all, including duplicates)
+      segments (number of not-connected!) path segments.
+  """
+  if numpy is not None:
+    pstat = svg_pathstats_numpy(path_d)
+    if pstat is not None:
+      return pstat
+  path_d = path_d.lower()
+  p_points = 0
+  p_length = 0
+  p_segments = 0
+  for p in path_d.split('m'):
+
+    pp = re.sub('[cl,]', ' ', p)
+    pp,closed = re.subn('z\s*$','',pp)
+    xy = pp.split()
+    if len(xy) < 2:
+      # print len(pp)
+      # print "short path error"
+      continue
+    x0 = float(xy[0])
+    y0 = float(xy[1])
+    p_points += 1
+    x = xy[2::2]
+    y = xy[3::2]
+    if len(x):
+      p_segments += 1
+      if closed:
+        x.append(x0)
+        y.append(y0)
+
+    for i in range(len(x)):
+      p_points += 1
+      dx = float(x[i]) - x0
+      dy = float(y[i]) - y0
+      p_length += math.sqrt( dx * dx + dy * dy )
+      x0,y0 = float(x[i]),float(y[i])
+
+  return { 'points':p_points, 'segments':p_segments, 'length':p_length }
+
+_pathstats_table = string.maketrans('mzcl,', '     ')
+
+def svg_pathstats_numpy(path_d):
+  """ same as svg_pathstats(), but all coordinates are parsed in one pass
+      and the statistics are computed with array operations.
+      Returns None, if the path cannot be parsed this way.
+  """
+  path_d = path_d.lower()
+  if not len(path_d):
+    return { 'points':0, 'segments':0, 'length':0 }
+  b = numpy.frombuffer(path_d, dtype=numpy.uint8)
+  is_m = (b == ord('m'))
+  is_space = (b == 32) | ((b >= 9) & (b <= 13))  # string.whitespace
+  is_sep = is_space | is_m | (b == ord('z')) | (b == ord('c')) | (b == ord('l')) | (b == ord(','))
+  char_sub = numpy.cumsum(is_m)                 # subpath index of each character
+  n_sub = char_sub[-1] + 1
+
+  # a number starts at each non-separator that follows a separator.
+  start = ~is_sep
+  start[1:] &= is_sep[:-1]
+  num_sub = char_sub[start]
+  xy = numpy.fromstring(path_d.translate(_pathstats_table), dtype=numpy.float64, sep=' ')
+  if len(xy) != len(num_sub):
+    return None
+  cnt = numpy.bincount(num_sub, minlength=n_sub)
+  if numpy.any(cnt % 2):
+    return None
+  x = xy[0::2]
+  y = xy[1::2]
+  pt_sub = num_sub[0::2]                        # subpath index of each point
+  npts = cnt // 2
+
+  # a subpath is closed, if its last non-blank character is a 'z'.
+  sig = numpy.nonzero(~(is_space | is_m))[0]
+  closed = numpy.zeros(n_sub, dtype=bool)
+  if len(sig):
+    sig_sub = char_sub[sig]
+    last = numpy.ones(len(sig), dtype=bool)
+    last[:-1] = sig_sub[1:] != sig_sub[:-1]
+    closed[sig_sub[last]] = (b[sig[last]] == ord('z'))
+  closed &= (npts > 1)
+
+  dist = numpy.hypot(numpy.diff(x), numpy.diff(y))
+  p_length = dist[pt_sub[1:] == pt_sub[:-1]].sum()
+  if numpy.any(closed):
+    subs = numpy.nonzero(closed)[0]
+    first = numpy.searchsorted(pt_sub, subs, 'left')
+    final = numpy.searchsorted(pt_sub, subs, 'right') - 1
+    p_length += numpy.hypot(x[final] - x[first], y[final] - y[first]).sum()
+
+  return { 'points':int(npts.sum() + closed.sum()), 'segments':int((npts > 1).sum()), 'length':float(p_length) }
+
+def candidate_thresholds(num_attempts):
+  """ the gray levels of num_attempts threshold candidates, evenly spaced between 0 and 256. """
+  return [ int(256.*(1+i)/(num_attempts+1)) for i in range(num_attempts) ]
+
+def bitmap_proxy_stats(dark):
+  """ cheap estimates of the svg_pathstats() of a centerline trace, computed directly from a
+      boolean numpy array, where True marks black pixels. Returns None for plainly unusable
+      bitmaps: no black pixels, or more black than white.
+
+      length: half of the perimeter is the length of the skeleton, for thin strokes.
+      segments: the euler number (8-connected components minus holes), counted with bit-quads.
+      points: two per segment.
+  """
+  black = numpy.count_nonzero(dark)
+  if black == 0 or black > 0.5 * dark.size:
+    return None
+  perimeter = numpy.count_nonzero(dark[:,1:] != dark[:,:-1]) + numpy.count_nonzero(dark[1:,:] != dark[:-1,:])
+  q = dark.astype(numpy.int8)
+  a,b,c,d = q[:-1,:-1], q[:-1,1:], q[1:,:-1], q[1:,1:]
+  n = a + b + c + d
+  q1 = numpy.count_nonzero(n == 1)
+  q3 = numpy.count_nonzero(n == 3)
+  qd = numpy.count_nonzero((n == 2) & (a == d))
+  euler = (q1 - q3 - 2 * qd) // 4
+  segments = max(abs(euler), 1)
+  return { 'black':black, 'length':perimeter * 0.5, 'segments':segments, 'points':2 * segments }
+
+def box_sums(sat, r):
+  """ the sums over the (2r+1) x (2r+1) boxes around each pixel, from a summed-area table sat
+      with a zero first row and column. Boxes are clipped at the image border.
+      Returns (sums, pixel counts).
+  """
+  h,w = sat.shape[0]-1, sat.shape[1]-1
+  y0 = numpy.clip(numpy.arange(h) - r, 0, h)
+  y1 = numpy.clip(numpy.arange(h) + r + 1, 0, h)
+  x0 = numpy.clip(numpy.arange(w) - r, 0, w)
+  x1 = numpy.clip(numpy.arange(w) + r + 1, 0, w)
+  total = sat[y1][:,x1]
+  total -= sat[y0][:,x1]
+  total -= sat[y1][:,x0]
+  total += sat[y0][:,x0]
+  return (total, (y1 - y0)[:,None] * (x1 - x0)[None,:])
+
+def adaptive_window(size, window=0):
+  """ the window of adaptive_bitmap() for an image of size. window 0 chooses 1/16 of the smaller side. """
+  if window < 1:
+    window = max(15, min(size) // 16)
+  return window
+
+def adaptive_bitmap(im, window=0, offset=16, smooth=2, box=None):
+  """ a bi-level image, where a pixel is black if it is darker than the mean of the window x window
+      pixels around it by more than offset. This is the mean adaptive threshold of OpenCV, see
+      testdata/adaptiveThreshold.py. Instead of the pixel itself, the mean of the (2*smooth+1)^2
+      pixels around it is compared, which suppresses noise like the blur in adaptiveThreshold.py.
+      Both means come from one summed-area table, so the cost per pixel does not depend on
+      the window size. window 0 chooses 1/16 of the smaller image side.
+      With box (x0, y0, x1, y1), only this part of im is done, from a margin of window/2 around it.
+      The result is the same as that part of the bitmap of the entire image, but the temporary
+      arrays are only as large as box and margin. This is how tiles are done.
+      Needs numpy. Returns (bitmap, number of black pixels, window).
+  """
+  window = adaptive_window(im.size, window)
+  if box is None:
+    box = (0, 0, im.size[0], im.size[1])
+  r = max(window // 2, smooth)
+  margin = (max(box[0] - r, 0), max(box[1] - r, 0), min(box[2] + r, im.size[0]), min(box[3] + r, im.size[1]))
+  if margin != (0, 0, im.size[0], im.size[1]):
+    im = im.crop(margin)
+  a = numpy.asarray(im, dtype=numpy.int64)
+  h,w = a.shape
+  sat = numpy.zeros((h+1, w+1), dtype=numpy.int64)
+  sat[1:,1:] = a.cumsum(axis=0).cumsum(axis=1)
+  total, count = box_sums(sat, window // 2)
+  if smooth > 0:
+    a, acount = box_sums(sat, smooth)
+  else:
+    acount = 1
+  # a/acount < total/count - offset, without a division.
+  dark = (a + offset * acount) * count < total * acount
+  dark = dark[box[1]-margin[1]:box[3]-margin[1], box[0]-margin[0]:box[2]-margin[0]]
+  bw = Image.fromarray(dark.astype(numpy.uint8) * 255, 'L').point(lambda v: v, mode='1')
+  return (bw, int(numpy.count_nonzero(dark)), window)
+
+def find_executable(name):
+  """ the path of an executable, searched in PATH like the shell does. None if not found.
+  """
+  if os.path.dirname(name):
+    return name if os.path.isfile(name) else None
+  exts = ['']
+  if sys_platform.startswith('win'):
+    exts += os.environ.get('PATHEXT', '.EXE').lower().split(os.pathsep)
+  for d in os.environ.get('PATH', '').split(os.pathsep):
+    for ext in exts:
+      p = os.path.join(d, name + ext)
+      if os.path.isfile(p) and os.access(p, os.X_OK):
+        return p
+  return None
+
+
+class Candidate(object):
+  """ the score of one threshold candidate of svg_centerline_trace().
+      Up to 255 of them are kept during a search, so they hold numbers only.
+      The path data is kept for the best candidate only, see keep_best() there.
+  """
+  __slots__ = ('threshold', 'bitmap', 'img_width', 'img_height', 'mean', 'length', 'segments', 'points', 'strokewidth')
+
+  def __init__(self, threshold, bitmap, img_width, img_height, mean, length, segments, points):
+    self.threshold   = threshold
+    self.bitmap      = bitmap           # number of pixels below threshold, identifies the bi-level image.
+    self.img_width   = img_width
+    self.img_height  = img_height
+    self.mean        = mean
+    if mean > 127:
+      self.mean      = 255 - mean       # should not happen
+    self.length      = length
+    self.segments    = segments
+    self.points      = points
+    blackpixels = img_width * img_height * self.mean / 255.
+    self.strokewidth = blackpixels / max(length, 1.0)
+
+  def with_threshold(self, threshold):
+    """ the same result for another threshold, that gives the same bi-level image. """
+    return Candidate(threshold, self.bitmap, self.img_width, self.img_height, self.mean,
+                     self.length, self.segments, self.points)
+
+
+class TraceTimeout(Exception):
+  """ raised when a trace run was killed by the candidate timeout, or when the time limit has passed. """
+  pass
+
+
+class TraceBackend(object):
+  """ Base class of the tracing backends.
+      A backend turns a bi-level PIL image into svg text in the format of
+      'autotrace --centerline --output-format=svg'. Backends are registered
+      in trace_backends by name, and selected with the --backend option.
+
+      Each backend has a method trace(bw, scratch_dir=None, name='bw'), that traces the
+      PIL mode '1' image bw, where set bits are black. It returns (svg, cmd), where cmd
+      is a list of words that describes what was done, for error messages. It raises
+      TraceTimeout if tracer.trace_timeout() is exceeded, and is called from worker threads.
+      The tracer calls it through trace_path().
+  """
+  name = None                   # the name in trace_backends.
+  needs_scratch_dir = False     # True: trace() writes files into scratch_dir.
+
+  def __init__(self, tracer):
+    self.tracer = tracer        # the TraceCenterline instance, for its options.
+    self.error_threshold = tracer.options.at_error_threshold
+    self.filter_iterations = tracer.options.at_filter_iterations
+
+  def key(self):
+    """ everything that affects the output of trace(), for the trace result cache. """
+    return (self.name, self.error_threshold, self.filter_iterations)
+
+  def trace_path(self, bw, scratch_dir=None, name='bw'):
+    """ trace bw with trace(), and return (path_d, pstat): the path data of all paths joined into one,
+        and its svg_pathstats(), or None if the caller has to measure path_d.
+        A backend that has the path data without svg text overrides this.
+        Errors are reported here, path_d is then empty.
+    """
+    svg,cmd = self.trace(bw, scratch_dir, name)
+    if not len(svg):
+      print >>sys.stderr, "autotrace_cmd: " + ' '.join(cmd)
+      if debug:
+        print >>sys.stderr, "ERROR: returned nothing, leaving tmp pbm file around for you to debug"
+      else:
+        print >>sys.stderr, "ERROR: returned nothing"
+      return ('', None)
+    with self.tracer.timing.span('parse', trace=name, bytes=len(svg)):
+      path_d = svg_path_d(svg)
+    if path_d is None:
+      print >>sys.stderr, "backend: " + repr(self.key())
+      print >>sys.stderr, "ERROR: no proper xml returned for %s: '%s'" % (name, svg)
+      return ('', None)
+    return (path_d, None)
+
+
+class AutotraceBackend(TraceBackend):
+  """ Run the external autotrace binary for each bitmap.
+
+  In 'pipe' mode, the bitmap is streamed to autotrace through /dev/stdin, no file is written.
+  In 'file' mode, a pbm file is written to scratch_dir. The caller is responsible to remove scratch_dir.
+  Mode 'auto' tries the pipe first, and falls back to a file, if the pipe returns nothing.
+  """
+  name = 'autotrace'
+
+  def __init__(self, tracer):
+    TraceBackend.__init__(self, tracer)
+    self.autotrace_cmd = [ autotrace_exe,
+        '--filter-iterations', str(tracer.options.at_filter_iterations),
+        '--error-threshold', str(tracer.options.at_error_threshold),
+        '--centerline',
+        '--input-format=pbm',
+        '--output-format=svg' ]
+    self.autotrace_cmd += tracer.autotrace_opts
+    self.binary = AutotraceBackend.binary_identity()
+    self.needs_scratch_dir = (tracer.autotrace_input != 'pipe')
+    # with a timeout, each run gets a process group of its own, so that a kill also reaches
+    # the children of autotrace wrapper scripts. Otherwise they keep the output pipe open.
+    self.process_group = (os.name == 'posix' and (tracer.time_limit > 0 or tracer.candidate_timeout > 0))
+    self.memory_limit = 0
+    if tracer.at_memory_limit > 0 and resource is not None:
+      self.memory_limit = int(tracer.at_memory_limit * 1000000)
+    self.preexec_fn = None
+    if self.process_group or self.memory_limit:
+      self.preexec_fn = self.preexec
+
+  def preexec(self):
+    """ runs in the child process, before autotrace starts. Allocations beyond the memory limit fail, autotrace exits. """
+    if self.process_group:
+      os.setpgrp()
+    if self.memory_limit:
+      resource.setrlimit(resource.RLIMIT_AS, (self.memory_limit, self.memory_limit))
+
+  @staticmethod
+  def binary_identity():
+    """ 'path:mtime:size' of the resolved autotrace binary, or None if it is not found.
+        It changes when autotrace is replaced, e.g. by an upgrade.
+    """
+    exe = find_executable(autotrace_exe)
+    if exe is None:
+      return None
+    exe = os.path.realpath(exe)
+    st = os.stat(exe)
+    return "%s:%d:%d" % (exe, st.st_mtime, st.st_size)
+
+  @staticmethod
+  def check(cache_dir=None):
+    """ Test if autotrace is installed and in path. Exits if not.
+        A successful test is remembered in cache_dir, keyed on the binary_identity(),
+        so that autotrace is only started again when it was replaced.
+    """
+    key = AutotraceBackend.binary_identity()
+    if key is None:
+      out,err = '', autotrace_exe + ': command not found'
+    else:
+      exe = key.rsplit(':', 2)[0]
+      probe_file = os.path.join(cache_dir, 'autotrace.probe') if cache_dir else None
+      try:
+        if probe_file and json.load(open(probe_file)).get('key') == key:
+          return
+      except (IOError, ValueError, AttributeError):
+        pass
+
+      p = subprocess.Popen([exe, '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      out,err = p.communicate()
+
+    found = out.find('AutoTrace')
+    if found == -1:
+        print >>sys.stderr, err
+        if err.find('cannot open shared object file'):
+          print >>sys.stderr, "NOTE: This build of autotrace is incompatible with your system, try a different build.\n"
+        print >>sys.stderr, "You need to install autotrace for this extension to work. Try https://github.com/jnweiger/autotrace/releases or search for autotrace version 0.40.0 or later."
+        exit()
+    if probe_file:
+      try:
+        if not os.path.isdir(cache_dir):
+          os.makedirs(cache_dir)
+        fd,tmpname = tempfile.mkstemp(prefix='.centerlinetrace', dir=cache_dir)
+        os.write(fd, json.dumps({ 'key': key, 'version': out.strip() }))
+        os.close(fd)
+        os.rename(tmpname, probe_file)
+      except (IOError, OSError):
+        pass                    # just test again next time.
+
+  def key(self):
+    return ('autotrace', self.binary, self.autotrace_cmd[1:])
+
+  def run(self, cmd, data=None):
+    """ run autotrace, and return its output. The run is killed after tracer.trace_timeout() seconds.
+    """
+    timeout = self.tracer.trace_timeout()
+    p = subprocess.Popen(cmd, stdin=(subprocess.PIPE if data is not None else None), stdout=subprocess.PIPE,
+                         preexec_fn=self.preexec_fn)
+    if timeout is None:
+      return p.communicate(data)[0]
+    killed = []
+    def kill():
+      if p.returncode is None:
+        killed.append(True)
+        try:
+          if self.process_group:
+            os.killpg(p.pid, signal.SIGKILL)
+          else:
+            p.kill()
+        except OSError:
+          pass                  # just exited.
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+      out = p.communicate(data)[0]
+    finally:
+      timer.cancel()
+    if killed:
+      raise TraceTimeout("autotrace killed after %.1fs" % timeout)
+    return out
+
+  def trace(self, bw, scratch_dir=None, name='bw'):
+    tracer = self.tracer
+    autotrace_cmd = self.autotrace_cmd
+    pbm = "P4\n%d %d\n" % (bw.size[0], bw.size[1]) + bw.tobytes()
+    mode = tracer.autotrace_input
+    if mode == 'auto':
+      mode = 'pipe' if tracer.pipe_ok else 'file'
+
+    if mode == 'pipe':
+      cmd = autotrace_cmd + ['/dev/stdin']
+      svg = self.run(cmd, pbm)
+      if len(svg) or tracer.autotrace_input == 'pipe':
+        return (svg, cmd)
+      print >>sys.stderr, "autotrace cannot read from /dev/stdin, falling back to files in " + scratch_dir
+      tracer.pipe_ok = False
+
+    fname = os.path.join(scratch_dir, name + '.pbm')
+    fp = open(fname, 'wb')
+    fp.write(pbm)
+    fp.close()
+    if debug: print >>tracer.tty, "pbm from bw done"
+    cmd = autotrace_cmd + [fname]
+    svg = self.run(cmd)         # on a timeout, the pbm file is removed with scratch_dir.
+    if len(svg) or not debug:
+      os.unlink(fname)
+    return (svg, cmd)
+
+
+class LibautotraceBackend(AutotraceBackend):
+  """ Call the autotrace shared library in-process through ctypes, see centerline_libautotrace.py.
+      Without the library, this is the AutotraceBackend, which runs the autotrace program.
+  """
+  name = 'libautotrace'
+
+  def __init__(self, tracer):
+    AutotraceBackend.__init__(self, tracer)
+    import centerline_libautotrace
+    self.libautotrace = centerline_libautotrace
+    self.lib = centerline_libautotrace.load()
+    if self.lib is not None:
+      self.needs_scratch_dir = False
+
+  @staticmethod
+  def note_missing(tty, cache_dir=None):
+    """ say that the library was not found and the autotrace program runs instead. Without the library this is
+        said on every run, so it is said only once per cache_dir, remembered next to the autotrace probe.
+    """
+    probe_file = os.path.join(cache_dir, 'libautotrace.probe') if cache_dir else None
+    if probe_file and os.path.exists(probe_file):
+      return
+    print >>tty, "libautotrace not found, running the autotrace program."
+    if probe_file:
+      try:
+        if not os.path.isdir(cache_dir):
+          os.makedirs(cache_dir)
+        open(probe_file, 'w').close()
+      except (IOError, OSError):
+        pass                    # just say it again next time.
+
+  def key(self):
+    if self.lib is None:
+      return AutotraceBackend.key(self)
+    return TraceBackend.key(self)
+
+  def trace(self, bw, scratch_dir=None, name='bw'):
+    if self.lib is None:
+      return AutotraceBackend.trace(self, bw, scratch_dir, name)
+    self.tracer.trace_timeout()         # in-process, it cannot be killed. But it does not start after the time limit.
+    # set bits of bw are black, autotrace expects black as 0.
+    pixels = bw.convert('L').point(lambda v: 255 - v).tobytes()
+    svg = self.libautotrace.trace(self.lib, pixels, bw.size[0], bw.size[1], self.error_threshold, self.filter_iterations)
+    return (svg, ['libautotrace', '--filter-iterations', str(self.filter_iterations),
+                  '--error-threshold', str(self.error_threshold), name])
+
+  def trace_path(self, bw, scratch_dir=None, name='bw'):
+    """ the path data and its statistics come straight from the spline arrays, no svg text is written or parsed.
+        The library fits one bitmap at a time, traces from several workers wait for each other.
+    """
+    if self.lib is None:
+      return AutotraceBackend.trace_path(self, bw, scratch_dir, name)
+    self.tracer.trace_timeout()
+    pixels = bw.convert('L').point(lambda v: 255 - v).tobytes()
+    return self.libautotrace.trace_path(self.lib, pixels, bw.size[0], bw.size[1], self.error_threshold, self.filter_iterations)
+
+
+class SkeletonBackend(TraceBackend):
+  """ Trace in-process with numpy: thinning, skeleton graph extraction and bezier fitting.
+      No autotrace binary and no subprocesses are needed. See centerline_skeleton.py
+  """
+  name = 'python'
+
+  def __init__(self, tracer):
+    TraceBackend.__init__(self, tracer)
+    lazy_imports()
+    if numpy is None:
+      print >>sys.stderr, "Error: The python backend needs numpy. Try\n  apt-get install python-numpy"
+      sys.exit(1)
+    import centerline_skeleton
+    self.skeleton = centerline_skeleton
+
+  def trace(self, bw, scratch_dir=None, name='bw'):
+    self.tracer.trace_timeout()         # in-process, it cannot be killed. But it does not start after the time limit.
+    svg = self.skeleton.centerline_svg(numpy.asarray(bw), self.error_threshold, self.filter_iterations)
+    return (svg, ['centerline_skeleton', '--filter-iterations', str(self.filter_iterations),
+                  '--error-threshold', str(self.error_threshold), name])
+
+
+trace_backends = { 'autotrace': AutotraceBackend, 'libautotrace': LibautotraceBackend, 'python': SkeletonBackend }
+
 class TraceCenterline(inkex.Effect):
   """
   Inkscape Extension make long continuous paths from smaller parts
@@ -133,25 +674,48 @@ class TraceCenterline(inkex.Effect):
     self.replace_image = False		 # True: remove image object when adding path object.
     self.candidates = 15		 # [1..255] Number of autotrace candidate runs.
     self.filter_median = 0		 # 0 to disable median filter.
+    self.despecle_mode = 'median'        # 'median' filter or 'rof' (total variation) denoising with filter_median as strength.
+    self.threshold_mode = 'global'       # 'global': search the best threshold for the image, 'adaptive': local mean threshold, one trace.
+    self.adaptive_window = 0             # [px] window of the local mean. 0: 1/16 of the smaller image side.
+    self.adaptive_offset = 16.0          # pixels this much darker than their local mean are black.
+    self.adaptive_smooth = 2             # [px] radius of the mean that is compared instead of the pixel itself. 0: the pixel.
+    self.rof_time = 0.5                  # [s] time budget of rof denoising.
+    self.rof_max_iterations = 100        # iteration limit of rof denoising per pyramid level.
     self.filter_equal_light = 0.0        # [0.0 .. 1.9] Use 1.0 with photos. Use 0.0 with perfect scans.
     self.hairline = False                # Fixed linewidth.
     self.hairline_width = 0.1            # Width of hairline [mm]
-
-    # Test if autotrace is installed and in path
-    command = autotrace_exe + ' --version'
-
-    p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return_code = p.wait()
-
-    out,err = p.communicate()
-
-    found = out.find('AutoTrace')
-    if found == -1:
-        print >>sys.stderr, err
-        if err.find('cannot open shared object file'):
-          print >>sys.stderr, "NOTE: This build of autotrace is incompatible with your system, try a different build.\n"
-        print >>sys.stderr, "You need to install autotrace for this extension to work. Try https://github.com/jnweiger/autotrace/releases or search for autotrace version 0.40.0 or later."
-        exit()
+    self.workers = 1                     # Number of parallel autotrace runs.
+    self.autotrace_input = 'auto'        # How the bitmap is passed to autotrace: 'pipe', 'file' or 'auto'.
+    self.search = 'sweep'                # Threshold search strategy: 'sweep', 'golden' or 'refine'.
+    self.prerank = 0                     # Trace only this many candidates, preselected from raster statistics. 0 to disable.
+    self.cache_size = 100.0              # [MB] of trace results kept in cache_dir. 0 to disable the cache.
+    self.cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                                  'inkscape-centerline-trace')
+    self.backend = 'autotrace'           # Name of the tracing backend in trace_backends.
+    self.tiles = False                   # True: trace large images in tiles, instead of scaling them down.
+    self.pyramid = 1                     # >1: search the threshold on an image scaled down by this factor, then trace once at full size.
+    self.tile_overlap = 8                # [px] tiles overlap by this much.
+    self.tile_join = 3.0                 # [px] paths cut at a seam are joined with their continuation within this distance.
+    self.memory_limit = 1024.0           # [MB] for tiles traced in parallel.
+    self.tile_bytes_per_pixel = 40       # estimated peak memory of a trace run per pixel.
+    self.adaptive_bytes_per_pixel = 56   # estimated peak memory of adaptive_bitmap() per pixel.
+    self.pipe_ok = not sys_platform.startswith('win')  # /dev/stdin is usable.
+    self.time_limit = 0.0                # [s] per image. Then the best candidate traced so far is used. 0 for no limit.
+    self.candidate_timeout = 0.0         # [s] autotrace runs are killed after this. 0 for no limit.
+    self.at_memory_limit = 0.0           # [MB] address space limit of the autotrace processes. 0 for no limit.
+    self.deadline = None                 # time.time() when the time limit of the current image is over.
+    self.timing = centerline_timing.Timing()   # spans of wall time, enabled with --timing-file.
+    self.timing_file = None
+    self.timing_format = 'json'          # 'json' or 'chrome'
+    self.preview = False                 # True: trace a small proxy with one candidate, for the live preview.
+    self.preview_time = 1.0              # [s] a preview should take about this long.
+    self.preview_limit = 2.0             # [MP] the preview proxy is never larger than this, the megapixel_limit of the options.
+    self.preview_sizes_kept = 100        # number of images that remember their preview proxy size.
+    self.join_tolerance = 0.0            # [px] join subpaths with end points closer than this. 0 to disable.
+    self.order = False                   # True: order and reverse subpaths for short pen-up moves.
+    self.compact = False                 # True: round, simplify and shorten the path data.
+    self.precision = 2                   # decimals of the path coordinates, with compact.
+    self.compact_tolerance = 0.1         # [px] lines and curves closer than this to a straight line are merged, with compact.
 
     try:
       self.tty = open("/dev/tty", 'w')
@@ -179,12 +743,67 @@ class TraceCenterline(inkex.Effect):
 
     self.OptionParser.add_option('-m', '--megapixels', action='store',
           type='float', default=2.0, help="Limit image size in megapixels. (Lower is faster)")
+    self.OptionParser.add_option('-t', '--tiles', action='store', type='inkbool', default=False, help='Trace large images in tiles at full resolution, instead of scaling down to the megapixel limit. (Default: False)')
+    self.OptionParser.add_option('--pyramid', action='store',
+          type='int', default=1, help="Search the threshold on a copy of the image scaled down by this factor, then trace once at full size. About as fast as --candidates=1. (Default 1: off)")
+    self.OptionParser.add_option('--tile-overlap', action='store',
+          type='int', default=8, help="Overlap of tiles in pixels: how far each tile sees beyond its seams. (Default: 8)")
+    self.OptionParser.add_option('--memory-limit', action='store',
+          type='float', default=1024.0, help="Memory budget in megabytes for tiles traced in parallel. (Default: 1024)")
     self.OptionParser.add_option('-e', '--equal-light', action='store',
           type='float', default=0.0, help="Equalize illumination. Use 1.0 with flash photography, use 0.0 to disable.")
     self.OptionParser.add_option('-c', '--candidates', action='store',
           type='int', default=15, help="[1..255] Autotrace candidate runs. (Lower is much faster)")
+    self.OptionParser.add_option('--cache', action='store', type='inkbool', default=True, help='Reuse trace results of identical images and settings. (Default: True)')
+    self.OptionParser.add_option('--cache-size', action='store',
+          type='float', default=100.0, help="Size limit of the trace result cache in megabytes. Least recently used results are dropped. (Default: 100)")
+    self.OptionParser.add_option('--cache-dir', action='store',
+          type='string', default=None, help="Directory for the trace result cache. (Default: ~/.cache/inkscape-centerline-trace)")
+    self.OptionParser.add_option('-s', '--search', action='store', type='choice', choices=['sweep', 'golden', 'refine'],
+          default='sweep', help="Threshold search: 'sweep' traces all candidates, 'golden' (golden-section) and 'refine' (coarse grid, then local refinement) trace far fewer. (Default: sweep)")
+    self.OptionParser.add_option('-k', '--prerank', action='store',
+          type='int', default=0, help="Estimate all candidates from their bitmaps, and run autotrace only on the best k of them. Needs numpy. (Default 0: trace all)")
+    self.OptionParser.add_option('-j', '--workers', action='store',
+          type='int', default=0, help="Number of autotrace candidates to run in parallel. (Default 0: number of CPUs)")
+    self.OptionParser.add_option('-P', '--processes', action='store',
+          type='int', default=0, help="Number of selected images traced in parallel. (Default 0: number of CPUs)")
+    self.OptionParser.add_option('--time-limit', action='store',
+          type='float', default=0.0, help="Seconds per image. Unfinished autotrace runs are killed then, and the best candidate traced so far is used. (Default 0: no limit)")
+    self.OptionParser.add_option('--candidate-timeout', action='store',
+          type='float', default=0.0, help="Kill an autotrace run after this many seconds, the candidate is skipped. (Default 0: no limit)")
+    self.OptionParser.add_option('--at-memory-limit', action='store',
+          type='float', default=0.0, help="Autotrace: limit the memory of each run to this many megabytes, the candidate is skipped if it needs more. Not on windows. (Default 0: no limit)")
+    self.OptionParser.add_option('-b', '--backend', action='store', type='choice', choices=sorted(trace_backends.keys()),
+          default='autotrace', help="Tracing backend: 'autotrace' runs the autotrace program, 'libautotrace' calls the autotrace library in-process (or runs the program if the library is missing), 'python' traces in-process with numpy. (Default: autotrace)")
+    self.OptionParser.add_option('--at-input', action='store', type='choice', choices=['auto', 'pipe', 'file'],
+          default='auto', help="How to pass the bitmap to autotrace: 'pipe' via /dev/stdin, 'file' via a scratch directory on tmpfs, or 'auto'. (Default: auto)")
+    self.OptionParser.add_option('--timing-file', action='store',
+          type='string', default=None, help="Record how long each stage takes and write it to this file. strftime() escapes are expanded, e.g. trace-%Y%m%d-%H%M%S.json (Default: off)")
+    self.OptionParser.add_option('--timing-format', action='store', type='choice', choices=['json', 'chrome'],
+          default='json', help="Format of --timing-file: 'json' with totals per stage, or 'chrome' trace events for chrome://tracing and perfetto. (Default: json)")
     self.OptionParser.add_option('-d', '--despecle', action='store',
           type='int', default=0, help="[0..9] Apply median filter for noise reduction. (Default 0, off)")
+    self.OptionParser.add_option('-a', '--threshold-mode', action='store', type='choice', choices=['global', 'adaptive'],
+          default='global', help="'global' searches the best threshold for the whole image with --candidates runs. 'adaptive' compares each pixel with the mean of its surroundings and traces once; good for unevenly lit photos, replaces --equal-light. Needs numpy. (Default: global)")
+    self.OptionParser.add_option('--adaptive-window', action='store',
+          type='int', default=0, help="Size of the surroundings in pixels for --threshold-mode=adaptive. Larger than the line width. (Default 0: 1/16 of the image)")
+    self.OptionParser.add_option('--adaptive-offset', action='store',
+          type='float', default=16.0, help="For --threshold-mode=adaptive, pixels must be this much darker than their surroundings to be black. (Default: 16)")
+    self.OptionParser.add_option('--despecle-mode', action='store', type='choice', choices=['median', 'rof'],
+          default='median', help="Noise reduction of --despecle: 'median' filter, or 'rof' total variation denoising, which keeps edges sharp. Needs numpy. (Default: median)")
+    self.OptionParser.add_option('--rof-time', action='store',
+          type='float', default=0.5, help="Time limit in seconds for rof denoising. (Default: 0.5)")
+    self.OptionParser.add_option('--preview', action='store', type='inkbool', default=False, help='Fast preview: trace a small copy of the image with one candidate. Turn off before applying. (Default: False)')
+    self.OptionParser.add_option('--preview-time', action='store',
+          type='float', default=1.0, help="With --preview, scale the image so that tracing takes about this many seconds. (Default: 1.0)")
+    self.OptionParser.add_option('--join-tolerance', action='store',
+          type='float', default=0.0, help="Join subpaths whose end points are closer than this many pixels, for fewer pen lifts. (Default 0: off)")
+    self.OptionParser.add_option('--order', action='store', type='inkbool', default=False, help='Order and reverse subpaths for short pen-up moves with plotters and lasers. (Default: False)')
+    self.OptionParser.add_option('--compact', action='store', type='inkbool', default=False, help='Write short path data: rounded, relative coordinates, straight runs merged. (Default: False)')
+    self.OptionParser.add_option('--precision', action='store',
+          type='int', default=2, help="Decimals of the path coordinates, with --compact. (Default: 2)")
+    self.OptionParser.add_option('--compact-tolerance', action='store',
+          type='float', default=0.1, help="Merge lines and flat curves that deviate less than this many pixels from a straight line, with --compact. 0 to disable. (Default: 0.1)")
     self.OptionParser.add_option('-D', '--debug-show', action='store_const', const=True, default=False, dest='debug', help='debugging: shows processed pictures.')
 
   def version(self):
@@ -192,35 +811,266 @@ class TraceCenterline(inkex.Effect):
   def author(self):
     return __author__
 
-  def svg_centerline_trace(self, image_file, cliprect=None):
-    """ svg_centerline_trace prepares the image by
-    a) limiting_size (aka runtime),
-    b) removing noise,
-    c) linear histogram expansion,
-    d) equalized spatial illumnination (my own algorithm)
+  def scratch_tempdir(self):
+    """ a directory for temporary files, preferably on a tmpfs.
+    """
+    for d in ('/dev/shm', '/run/shm'):
+      if os.path.isdir(d) and os.access(d, os.W_OK):
+        return d
+    return tempfile.gettempdir()
 
-    Then we run several iterations of autotrace and find the optimal black white threshold by evaluating
-    all outputs. The output with the longest total path and the least path elements wins.
+  def image_digest(self, im, orig_im_size):
+    """ a hash over the decoded image. im is the decoded part of the image inside the cliprect.
+    """
+    h = hashlib.sha1()
+    h.update(repr((__version__, orig_im_size, im.mode, im.size)))
+    h.update(im.tobytes())
+    return h.hexdigest()
 
-    A cliprect dict with the keys x, y, w, h can be specified. All 4 are expected in the
-    range 0..1 and are mapped to the image width and height.
+  def cache_key(self, digest, cliprect, backend):
+    """ a hash over the image_digest() of the decoded image, the cliprect and all options that affect the trace result.
     """
-    num_attempts = self.candidates	# 15 is great. min 1, max 255, beware it gets much slower with more attempts.
-    autotrace_cmd = [ autotrace_exe,
-        '--filter-iterations', str(self.options.at_filter_iterations),
-        '--error-threshold', str(self.options.at_error_threshold),
-        '--centerline',
-        '--input-format=pbm',
-        '--output-format=svg' ]
-    autotrace_cmd += self.autotrace_opts
+    h = hashlib.sha1()
+    h.update(digest)
+    if cliprect is not None:
+      cliprect = tuple([ cliprect[k] for k in ('x', 'y', 'w', 'h') ])
+    h.update(repr((cliprect, backend.key(), self.megapixel_limit, self.tiles, self.tile_overlap, self.tile_join,
+                   self.candidates, self.search, self.prerank, self.pyramid,
+                   self.filter_median, self.despecle_mode, self.rof_time, self.filter_equal_light, self.invert_image,
+                   self.threshold_mode, self.adaptive_window, self.adaptive_offset, self.adaptive_smooth)))
+    return h.hexdigest()
+
+  def cache_load(self, key):
+    """ return the cached (path_d, strokewidth, im_size) tuple for key, or None.
+    """
+    fname = os.path.join(self.cache_dir, key + '.json')
+    try:
+      fp = open(fname, 'r')
+      data = json.load(fp)
+      fp.close()
+      os.utime(fname, None)               # least recently used is evicted first.
+      return ( str(data['path_d']), data['strokewidth'], tuple(data['im_size']) )
+    except (IOError, OSError, ValueError, KeyError):
+      return None                         # KeyError: an entry of a version that cached svg text.
 
-    stroke_style_add = 'stroke-width:%.2f; fill:none; stroke-linecap:round;'
+  def cache_store(self, key, result):
+    """ store a trace result, then evict least recently used entries until the cache fits into cache_size megabytes.
+    """
+    try:
+      if not os.path.isdir(self.cache_dir):
+        os.makedirs(self.cache_dir)
+      fd,tmpname = tempfile.mkstemp(prefix='.centerlinetrace', dir=self.cache_dir)
+      fp = os.fdopen(fd, 'w')
+      json.dump({ 'path_d':result[0], 'strokewidth':result[1], 'im_size':result[2] }, fp)
+      fp.close()
+      os.rename(tmpname, os.path.join(self.cache_dir, key + '.json'))
+    except (IOError, OSError) as e:
+      print >>sys.stderr, "Warning: cannot write cache " + self.cache_dir + ": " + str(e)
+      return
+    self.cache_evict()
 
+  def cache_evict(self):
+    """ remove least recently used trace results and prepared images until the cache fits into cache_size megabytes.
+        The image workers evict at the same time, files that another one removed first are skipped.
+    """
+    def gone(e):
+      return getattr(e, 'errno', None) == errno.ENOENT
+
+    try:
+      entries = []
+      for name in os.listdir(self.cache_dir):
+        if name.endswith('.json') or name.endswith('.png'):
+          try:
+            st = os.stat(os.path.join(self.cache_dir, name))
+          except OSError as e:
+            if not gone(e): raise
+            continue
+          entries.append((st.st_mtime, st.st_size, name))
+      entries.sort()
+      total = sum([ e[1] for e in entries ])
+      while entries and total > self.cache_size * 1000000:
+        mtime,size,name = entries.pop(0)
+        try:
+          os.unlink(os.path.join(self.cache_dir, name))
+        except OSError as e:
+          if not gone(e): raise
+        total -= size
+    except (IOError, OSError) as e:
+      if not gone(e):                   # no cache_dir yet.
+        print >>sys.stderr, "Warning: cannot evict from cache " + self.cache_dir + ": " + str(e)
+
+  def image_source_hash(self, h, image_file, with_mtime=False):
+    """ update the hash h with the image source: the absolute file name, with its mtime and size if with_mtime,
+        or the content of an in-memory file. Returns False if a file name cannot be found.
+    """
+    if not isinstance(image_file, basestring):
+      h.update(image_file.getvalue())
+      return True
+    try:
+      st = os.stat(image_file)
+    except OSError:
+      return False
+    h.update(repr(os.path.abspath(image_file)))
+    if with_mtime:
+      h.update(repr((st.st_mtime, st.st_size)))
+    return True
+
+  def prepared_key(self, image_file, cliprect, adaptive):
+    """ a hash over the image source, the cliprect and all options of decode_image() and preprocess_image().
+        image_file is a file name, or an in-memory file with an embedded image.
+        Returns None if a file name cannot be found.
+    """
+    h = hashlib.sha1()
+    if not self.image_source_hash(h, image_file, True):
+      return None
+    if cliprect is not None:
+      cliprect = tuple([ cliprect[k] for k in ('x', 'y', 'w', 'h') ])
+    h.update(repr((__version__, cliprect, self.megapixel_limit, self.tiles, self.invert_image,
+                   self.filter_median, self.despecle_mode, self.rof_time,
+                   0.0 if adaptive else self.filter_equal_light)))
+    return 'prepared-' + h.hexdigest()
+
+  def prepared_load(self, key):
+    """ return the (im, orig_im_size, im_scale, tiled, scale_limit, digest) tuple stored for key, or None.
+    """
+    if key is None:
+      return None
+    fname = os.path.join(self.cache_dir, key + '.png')
+    try:
+      im = Image.open(fname)
+      im.load()
+      meta = json.loads(im.info['centerline-trace'])
+      os.utime(fname, None)
+    except (IOError, OSError, ValueError, KeyError):
+      return None
+    return (im, tuple(meta['orig_im_size']), meta['im_scale'], meta['tiled'], meta['scale_limit'], str(meta['digest']))
+
+  def prepared_store(self, key, prepared):
+    """ store a preprocessed image as png, with the rest of the tuple in a text chunk.
+        Saved without much compression, loading it must be much faster than decoding and filtering again.
+    """
+    from PIL import PngImagePlugin
+    im, orig_im_size, im_scale, tiled, scale_limit, digest = prepared
+    info = PngImagePlugin.PngInfo()
+    info.add_text('centerline-trace', json.dumps({ 'orig_im_size': orig_im_size, 'im_scale': im_scale,
+                  'tiled': tiled, 'scale_limit': scale_limit, 'digest': digest }))
+    try:
+      if not os.path.isdir(self.cache_dir):
+        os.makedirs(self.cache_dir)
+      fd,tmpname = tempfile.mkstemp(prefix='.centerlinetrace', dir=self.cache_dir)
+      fp = os.fdopen(fd, 'wb')
+      im.save(fp, 'PNG', pnginfo=info, compress_level=1)
+      fp.close()
+      os.rename(tmpname, os.path.join(self.cache_dir, key + '.png'))
+    except (IOError, OSError) as e:
+      print >>sys.stderr, "Warning: cannot write cache " + self.cache_dir + ": " + str(e)
+      return
+    self.cache_evict()
+
+  def tile_size(self):
+    """ the side of the square tiles of trace_tiles(), in pixels. The seams are at multiples of it. """
+    return max(int(math.sqrt(self.megapixel_limit * 1000000)), 4 * self.tile_overlap)
+
+  def trace_tiles(self, backend, im, threshold, bitmap=None, bitmap_margin=0):
+    """ trace the entire image im at the given threshold, in overlapping tiles of megapixel_limit.
+    If bitmap is given, bitmap(crop, core) returns the bi-level image of each tile instead, where crop is
+    the box of the tile with its overlap, and core the part of it that the tile keeps. It may read
+    bitmap_margin pixels around crop, which counts for the memory of the tile.
+    Tiles are traced in parallel, but only as many at once, as fit into memory_limit.
+    Segments are cut where they cross a seam, and each tile keeps the parts in its own part of the image.
+    Paths cut at a seam are joined with their continuation in the neighbour tile, within tile_join pixels.
+    Returns the path data.
+    """
+    w,h = im.size
+    tile = self.tile_size()
+    m = self.tile_overlap
+    xs = range(0, w, tile)
+    ys = range(0, h, tile)
+    boxes = [ (x, y, min(x+tile, w), min(y+tile, h)) for y in ys for x in xs ]
+    if bitmap is None:
+      lut = [ 255 for n in range(threshold) ] + [ 0 for n in range(threshold,256) ]
+
+    tile_bytes = (tile + 2*m + 2) ** 2 * self.tile_bytes_per_pixel
+    if bitmap is not None:
+      tile_bytes += (tile + 2*m + 2*bitmap_margin) ** 2 * self.adaptive_bytes_per_pixel
+    num_workers = max(1, min(self.workers, len(boxes), int(self.memory_limit * 1000000 / tile_bytes)))
+    if debug: print >>self.tty, "tiles: %d tiles of %dx%d pixels, %d in parallel" % (len(boxes), tile, tile, num_workers)
+
+    def trace_tile(k):
+      core = boxes[k]
+      crop = (max(core[0]-m, 0), max(core[1]-m, 0), min(core[2]+m, w), min(core[3]+m, h))
+      if bitmap is None:
+        bw = ImageOps.expand(im.crop(crop), border=1, fill=255).point(lut, mode='1')
+      else:
+        bw = ImageOps.expand(bitmap(crop, core), border=1, fill=0)
+      try:
+        with self.timing.span('trace', tile=k, backend=self.backend):
+          path_d, pstat = backend.trace_path(bw, scratch_dir, "centerlinetile_%04d" % k)
+      except TraceTimeout as e:
+        print >>sys.stderr, "Time limit: tile %d not traced, %s" % (k, e)
+        return (k, [])
+
+      def keep(x0, y0, x1, y1):
+        # the outer border of the image belongs to the tile next to it.
+        mx, my = 0.5 * (x0 + x1), 0.5 * (y0 + y1)
+        return ((core[0] == 0 or mx >= core[0]) and (core[2] == w or mx < core[2]) and
+                (core[1] == 0 or my >= core[1]) and (core[3] == h or my < core[3]))
+
+      seams_x = [ x for x in (core[0], core[2]) if 0 < x < w ]
+      seams_y = [ y for y in (core[1], core[3]) if 0 < y < h ]
+      subs = []
+      for sub in centerline_paths.path_parse(path_d):
+        sub = centerline_paths.subpath_translate(sub, crop[0] - 1, crop[1] - 1)
+        sub = centerline_paths.subpath_cut(sub, seams_x, seams_y)
+        subs.extend(centerline_paths.subpath_split(sub, keep))
+      return (k, subs)
+
+    def on_seam(x, y):
+      # subpath_cut() puts the cut points exactly onto the seams.
+      return (x % tile == 0 and 0 < x < w) or (y % tile == 0 and 0 < y < h)
+
+    tiles = {}
+    scratch_dir = None
+    if backend.needs_scratch_dir:
+      scratch_dir = tempfile.mkdtemp(prefix="centerlinetrace", dir=self.scratch_tempdir())
+    pool = ThreadPool(num_workers)
+    try:
+      for k, subs in pool.imap_unordered(trace_tile, range(len(boxes))):
+        tiles[k] = subs
+    finally:
+      pool.terminate()
+      if scratch_dir is not None and not debug:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    subs = []
+    for k in range(len(boxes)):
+      subs.extend(tiles[k])
+    subs = centerline_paths.subpaths_join(subs, self.tile_join, on_seam)
+    return centerline_paths.path_format(subs)
+
+  def decode_image(self, image_file, cliprect=None):
+    """ decode the part of the image inside the cliprect, as grayscale.
+        Returns (im, orig_im_size, im_scale), im is None if the cliprect does not overlap the image.
+    """
+    timing = self.timing
+    with timing.span('decode') as span:
+      im = Image.open(image_file)
+      orig_im_size = (im.size[0], im.size[1])
+      im_scale = 1.0              # pixels in orig_im_size per pixel traced.
+
+      # JPEG can decode at 1/2, 1/4 or 1/8 of the size, and straight to grayscale. Ask for the
+      # smallest size that still satisfies the megapixel limit for the part inside the cliprect.
+      if im.format == 'JPEG' and not self.tiles:
+        area = 1.0
+        if cliprect is not None:
+          area = max(0.0, min(cliprect['w'], 1.0)) * max(0.0, min(cliprect['h'], 1.0))
+        draft_scale = max(1.0, math.sqrt(im.size[0] * im.size[1] * area * 0.000001 / self.megapixel_limit))
+        im.draft('L', (int(im.size[0]/draft_scale), int(im.size[1]/draft_scale)))
+        im_scale = orig_im_size[0] / float(im.size[0])
+        if debug: print >>self.tty, "draft: " + str([im.mode, im.size, im_scale])
+      im.load()
+      span.set(format=im.format, mode=im.mode, size=im.size, orig_size=orig_im_size)
 
-    if debug: print >>self.tty, "svg_centerline_trace start "+image_file
-    if debug: print >>self.tty, '+ '+' '.join(autotrace_cmd)
-    im = Image.open(image_file)
-    orig_im_size = (im.size[0], im.size[1])
     box=[0,0,0,0]
     if cliprect is not None:
       box[0] = cliprect['x'] * im.size[0]
@@ -230,116 +1080,222 @@ class TraceCenterline(inkex.Effect):
       box[3] = sorted((0, int(0.5 + box[1] + cliprect['h'] * im.size[1]), im.size[1]))[1]
       box[0] = sorted((0, int(0.5 + box[0]),                              im.size[0]))[1]
       box[1] = sorted((0, int(0.5 + box[1]),                              im.size[1]))[1]
-      im = im.crop(box)
       if box[0] == box[2] or box[1] == box[3]:
         print >>sys.stderr, "ERROR: Cliprect and Image do not overlap.", orig_im_size, box, cliprect
-        return ( '<svg/>', 1, orig_im_size)
+        return (None, orig_im_size, im_scale)
+      with timing.span('crop', box=box):
+        im = im.crop(box)       # before any mode conversion, so that only the cliprect is converted.
 
     if 'A' in im.mode:
       # this image has alpha. Paste it onto white or black.
-      im = im.convert("RGBA")
-      if self.invert_image:
-        bg = Image.new('RGBA', im.size, (0,0,0,255)) # black background
-      else:
-        bg = Image.new('RGBA', im.size, (255,255,255,255)) # white background
-      im = Image.alpha_composite(bg, im)
-
-    im = im.convert(mode='L', dither=None)
+      with timing.span('alpha'):
+        im = im.convert("RGBA")
+        if self.invert_image:
+          bg = Image.new('RGBA', im.size, (0,0,0,255)) # black background
+        else:
+          bg = Image.new('RGBA', im.size, (255,255,255,255)) # white background
+        im = Image.alpha_composite(bg, im)
+
+    with timing.span('convert', mode=im.mode):
+      im = im.convert(mode='L', dither=None)
     if debug: print >>self.tty, "seen: " + str([im.format, im.size, im.mode])
+    return (im, orig_im_size, im_scale)
+
+  def preprocess_image(self, im, im_scale, adaptive=False):
+    """ scale the decoded image down to the megapixel limit (unless tiled), invert, pad, denoise,
+        and expand its histogram. With adaptive, the light is not equalized.
+        Returns (im, im_scale, tiled, scale_limit).
+    """
+    timing = self.timing
     scale_limit = math.sqrt(im.size[0] * im.size[1] * 0.000001 / self.megapixel_limit)
-    if scale_limit > 1.0:
-      print >>sys.stderr, "Megapixel limit ("+str(self.megapixel_limit)+ ") exceeded. Scaling down by factor : "+str(scale_limit)
-      im = im.resize((int(im.size[0]/scale_limit), int(im.size[1]/scale_limit)), resample = Image.BILINEAR)
+    tiled = False
+    if scale_limit > 1.0 and self.tiles:
+      # keep the full resolution. The threshold search runs on a scaled down copy, see below.
+      print >>sys.stderr, "Megapixel limit ("+str(self.megapixel_limit)+ ") exceeded. Tracing in tiles."
+      tiled = True
+    elif scale_limit > 1.0:
+      print >>sys.stderr, "Megapixel limit ("+str(self.megapixel_limit)+ ") exceeded. Scaling down by factor : "+str(scale_limit*im_scale)
+      w = im.size[0]
+      with timing.span('resize', size=im.size):
+        im = im.resize((int(im.size[0]/scale_limit), int(im.size[1]/scale_limit)), resample = Image.BILINEAR)
+      im_scale *= w / float(im.size[0])
 
     if self.invert_image: im = ImageOps.invert(im)
 
     ### Add a one pixel padding around the image. Otherwise autotrace fails when a line touches the edge of the image.
     im = ImageOps.expand(im, border=1, fill=255)
 
-    if self.filter_median > 0:
+    if self.filter_median > 0 and self.despecle_mode == 'rof' and numpy is None:
+      print >>sys.stderr, "Warning: rof denoising needs numpy. Using the median filter. Try\n  apt-get install python-numpy"
+      self.despecle_mode = 'median'
+    if self.filter_median > 0 and self.despecle_mode == 'rof':
+      with timing.span('rof', weight=self.filter_median) as span:
+        im, iterations = self.rof_denoise(im, self.filter_median)
+        span.set(iterations=iterations)
+    elif self.filter_median > 0:
       if self.filter_median % 2 == 0: self.filter_median = self.filter_median + 1	# need odd values.
-      im = im.filter(ImageFilter.MedianFilter(size=self.filter_median))	                # feeble denoise attempt. FIXME: try ROF instead.
-    im = ImageOps.autocontrast(im, cutoff=0)	# linear expand histogram (an alternative to equalize)
+      with timing.span('median', size=self.filter_median):
+        im = im.filter(ImageFilter.MedianFilter(size=self.filter_median))	                # feeble denoise attempt. See also --despecle-mode=rof
+    with timing.span('autocontrast'):
+      im = ImageOps.autocontrast(im, cutoff=0)	# linear expand histogram (an alternative to equalize)
     ## cutoff=2 destroys some images, see https://github.com/fablabnbg/inkscape-centerline-trace/issues/28
 
     # not needed here:
     # im = im.filter(ImageFilter.UnsharpMask(radius=2, percent=150, threshold=3))	# parameters depend on size of image!
 
-    if self.filter_equal_light > 0.0:
-      scale_thumb = math.sqrt(im.size[0] * im.size[1] * 0.0001) 	# exactly 0.01 MP (e.g. 100x100)
-      im_neg_thumb = ImageOps.invert(im.resize((int(im.size[0]/scale_thumb), int(im.size[1]/scale_thumb)), resample = Image.BILINEAR))
-      im_neg_thumb = im_neg_thumb.filter(ImageFilter.GaussianBlur(radius=30))
-      im_neg_blur = im_neg_thumb.resize(im.size, resample=Image.BILINEAR)
-      if self.options.debug: im_neg_blur.show()
-
-      if debug: print >>self.tty, "ImageOps.equalize(im) done"
-      im = Image.blend(im, im_neg_blur, self.filter_equal_light*0.5)
-      im = ImageOps.autocontrast(im, cutoff=0)	# linear expand histogram (an alternative to equalize)
+    if self.filter_equal_light > 0.0 and not adaptive:    # the local threshold already compensates uneven light.
+      with timing.span('equal-light', strength=self.filter_equal_light):
+        scale_thumb = math.sqrt(im.size[0] * im.size[1] * 0.0001) 	# exactly 0.01 MP (e.g. 100x100)
+        im_neg_thumb = ImageOps.invert(im.resize((int(im.size[0]/scale_thumb), int(im.size[1]/scale_thumb)), resample = Image.BILINEAR))
+        im_neg_thumb = im_neg_thumb.filter(ImageFilter.GaussianBlur(radius=30))
+        im_neg_blur = im_neg_thumb.resize(im.size, resample=Image.BILINEAR)
+        if self.options.debug: im_neg_blur.show()
+
+        if debug: print >>self.tty, "ImageOps.equalize(im) done"
+        im = Image.blend(im, im_neg_blur, self.filter_equal_light*0.5)
+        im = ImageOps.autocontrast(im, cutoff=0)	# linear expand histogram (an alternative to equalize)
       if self.options.debug: im.show()
+    return (im, im_scale, tiled, scale_limit)
 
-    def svg_pathstats(path_d):
-      """ calculate statistics from an svg path:
-          length (measuring bezier splines as straight lines through the handles).
-          points (all, including duplicates)
-          segments (number of not-connected!) path segments.
-      """
-      path_d = path_d.lower()
-      p_points = 0
-      p_length = 0
-      p_segments = 0
-      for p in path_d.split('m'):
-
-        pp = re.sub('[cl,]', ' ', p)
-        pp,closed = re.subn('z\s*$','',pp)
-        xy = pp.split()
-        if len(xy) < 2:
-          # print len(pp)
-          # print "short path error"
-          continue
-        x0 = float(xy[0])
-        y0 = float(xy[1])
-        p_points += 1
-        x = xy[2::2]
-        y = xy[3::2]
-        if len(x):
-          p_segments += 1
-          if closed:
-            x.extend(x0)
-            y.extend(y0)
-
-        for i in range(len(x)):
-          p_points += 1
-          dx = float(x[i]) - x0
-          dy = float(y[i]) - y0
-          p_length += math.sqrt( dx * dx + dy * dy )
-          x0,y0 = float(x[i]),float(y[i])
-
-      return { 'points':p_points, 'segments':p_segments, 'length':p_length }
+  def svg_centerline_trace(self, image_file, cliprect=None):
+    """ svg_centerline_trace prepares the image by
+    a) limiting_size (aka runtime),
+    b) removing noise,
+    c) linear histogram expansion,
+    d) equalized spatial illumnination (my own algorithm)
+
+    Then we run several iterations of autotrace and find the optimal black white threshold by evaluating
+    all outputs. The output with the longest total path and the least path elements wins.
+
+    A cliprect dict with the keys x, y, w, h can be specified. All 4 are expected in the
+    range 0..1 and are mapped to the image width and height.
+
+    Returns (path_d, strokewidth, im_size). path_d is the svg path data of the best trace,
+    or empty if nothing was traced.
+    """
+    lazy_imports()
+    self.deadline = time.time() + self.time_limit if self.time_limit > 0 else None
+    num_attempts = self.candidates	# 15 is great. min 1, max 255, beware it gets much slower with more attempts.
+    if self.preview and numpy is None:
+      num_attempts = 1                  # prerank() needs numpy. Trace the middle threshold.
+    backend = trace_backends[self.backend](self)
+
+    stroke_style_add = 'stroke-width:%.2f; fill:none; stroke-linecap:round;'
+
+
+    if debug: print >>self.tty, "svg_centerline_trace start "+str(image_file)
+    if debug: print >>self.tty, '+ '+repr(backend.key())
+    timing = self.timing
+    adaptive = (self.threshold_mode == 'adaptive')
+    if adaptive and numpy is None:
+      print >>sys.stderr, "Warning: the adaptive threshold needs numpy. Searching a global threshold. Try\n  apt-get install python-numpy"
+      adaptive = False
+
+    # the preprocessed image of an earlier preview, e.g. with other autotrace options. Only the small proxies
+    # of the live preview are kept, a full size run would write and read back more than it saves.
+    prepared_key = None
+    prepared = None
+    if self.preview:
+      self.megapixel_limit = self.preview_megapixels(image_file, cliprect)
+      if debug: print >>self.tty, "preview: %g megapixels, one candidate" % self.megapixel_limit
+    if self.cache_size > 0 and self.preview:
+      with timing.span('prepared-load') as span:
+        prepared_key = self.prepared_key(image_file, cliprect, adaptive)
+        prepared = self.prepared_load(prepared_key)
+        span.set(hit=prepared is not None)
+    if prepared is not None:
+      im, orig_im_size, im_scale, tiled, scale_limit, digest = prepared
+    else:
+      im, orig_im_size, im_scale = self.decode_image(image_file, cliprect)
+      if im is None:
+        return ( '', 1, orig_im_size)
+      digest = self.image_digest(im, orig_im_size)
+
+    cache_key = None
+    if self.cache_size > 0:
+      with timing.span('cache-load') as span:
+        cache_key = self.cache_key(digest, cliprect, backend)
+        cached = self.cache_load(cache_key)
+        span.set(hit=cached is not None)
+      if cached is not None:
+        if debug: print >>self.tty, "cache hit: " + cache_key
+        self.cache_evict()              # the cache_size may have been lowered since the last store.
+        return cached
+
+    if prepared is None:
+      im, im_scale, tiled, scale_limit = self.preprocess_image(im, im_scale, adaptive)
+      if prepared_key is not None and im.size[0] * im.size[1] * len(im.getbands()) < self.cache_size * 1000000:
+        with timing.span('prepared-store'):
+          self.prepared_store(prepared_key, (im, orig_im_size, im_scale, tiled, scale_limit, digest))
+    trace_start = time.time()
 
     # slice with a list of histogram maps
     # 1 -> 128
     # 3 -> 64,128,192
     # ...
 
-    candidate = {}
-    if self.options.debug: im.show()
+    # im_size is the size of the entire image in the pixels of the traced path.
+    im_size = (orig_im_size[0] / im_scale, orig_im_size[1] / im_scale)
+
+    if adaptive:
+      result = self.trace_adaptive(backend, im, tiled, im_size)
+      if self.preview:
+        self.preview_size_store(image_file, cliprect, time.time() - trace_start, im_scale > 1.0)
+      if cache_key is not None:
+        with timing.span('cache-store'):
+          self.cache_store(cache_key, result)
+      return result
+
+    im_full = None
+    if tiled:
+      im_full = im
+      im = im.resize((int(im.size[0]/scale_limit), int(im.size[1]/scale_limit)), resample = Image.BILINEAR)
 
-    for i in range(num_attempts):
-      threshold = int(256.*(1+i)/(num_attempts+1))
+    # pyramid: the candidates are traced at a lower resolution, where lengths and the image size
+    # are multiplied with search_scale to match the full size. Only the best one is traced at full size.
+    im_pyramid = None
+    search_scale = 1.0
+    if self.pyramid > 1 and not tiled and num_attempts > 1:
+      f = min(float(self.pyramid), min(im.size) / 64.)        # keep lines wider than a pixel recognizable.
+      if f > 1.0:
+        im_pyramid = im
+        with timing.span('pyramid', factor=f):
+          im = im.resize((int(im.size[0]/f), int(im.size[1]/f)), resample = Image.BILINEAR)
+        search_scale = im_pyramid.size[0] / float(im.size[0])
+
+    candidate = {}              # index -> Candidate
+    if self.options.debug: im.show()
+    im_mean = ImageStat.Stat(im).mean[0]
+    thresholds = candidate_thresholds(num_attempts)
+
+    # Two thresholds produce the same bitmap, if no pixel value lies between them.
+    # The number of pixels below the threshold identifies the bitmap.
+    below = [0]
+    for h in im.histogram():
+      below.append(below[-1] + h)
+    bitmap_traced = {}          # below[threshold] -> index of the candidate traced with this bitmap
+    batch_dups = {}             # below[threshold] -> indices of the current batch, that reuse this bitmap
+
+    def trace_candidate(i):
+      """ run one autotrace attempt at threshold index i. This is called from worker threads,
+          it must not touch shared state other than returning its result.
+          Returns (i, (path_d, pstat)) as backend.trace_path() does, or (i, None) on a timeout.
+      """
+      threshold = thresholds[i]
       # make lookup table that maps to black/white using threshold.
       lut = [ 255 for n in range(threshold) ] + [ 0 for n in range(threshold,256) ]
       if debug: print >>self.tty, "attempt "+ str(i)
-      bw = im.point(lut, mode='1')
+      with timing.span('bitmap', candidate=i, threshold=threshold):
+        bw = im.point(lut, mode='1')
       if debug: print >>self.tty, "bw from lut done: threshold=%d" % threshold
       if self.options.debug: bw.show(command="/usr/bin/display -title=bw:threshold=%d" % threshold)
-      cand = { 'threshold':threshold, 'img_width':bw.size[0], 'img_height':bw.size[1], 'mean': ImageStat.Stat(im).mean[0] }
-      fp = tempfile.NamedTemporaryFile(prefix="centerlinetrace", suffix='.pbm', delete=False)
-      fp.write("P4\n%d %d\n" % (bw.size[0], bw.size[1]))
-      fp.write(bw.tobytes())
-      fp.close()
-      if debug: print >>self.tty, "pbm from bw done"
       # try:
-      p = subprocess.Popen(autotrace_cmd + [fp.name], stdout=subprocess.PIPE)
+      try:
+        with timing.span('trace', candidate=i, threshold=threshold, backend=self.backend):
+          traced = backend.trace_path(bw, scratch_dir, "centerlinetrace_%03d" % i)
+      except TraceTimeout as e:
+        if debug: print >>self.tty, "candidate %d: %s" % (i, e)
+        return (i, None)
 
       # the following crashes Inkscape (!) when used with GUI and autotrace not installed
       #except Exception as e:
@@ -348,61 +1304,282 @@ class TraceCenterline(inkex.Effect):
         #print "Try:\n  sudo apt-get install autotrace"
         #sys.exit(1)
 
-      cand['svg'] = p.communicate()[0]
       if debug: print >>self.tty, "autotrace done"
-      if not len(cand['svg']):
-        print >>sys.stderr, "autotrace_cmd: " + ' '.join(autotrace_cmd + [fp.name])
-        print >>sys.stderr, "ERROR: returned nothing, leaving tmp bmp file around for you to debug"
-        cand['svg'] = '<svg/>'                  # empty dummy
-      else:
-        os.unlink(fp.name)
+      return (i, traced)
 
-      # <?xml version="1.0" standalone="yes"?>\n<svg width="86" height="83">\n<path style="stroke:#000000; fill:none;" d="M36 15C37.9219 18.1496 41.7926 19.6686 43.2585 23.1042C47.9556 34.1128 39.524 32.0995 35.179 37.6034C32.6296 40.8328 34 48.1105 34 52M36 17C32.075 22.4565 31.8375 30.074 35 36M74 42L46 38C45.9991 46.1415 46.7299 56.0825 45.6319 64C44.1349 74.7955 23.7094 77.5566 16.044 72.3966C7.27363 66.4928 8.04426 45.0047 16.2276 38.7384C20.6362 35.3626 27.7809 36.0006 33 36M44 37L45 37"/>\n</svg>
-      try:
-        xml = inkex.etree.fromstring(cand['svg'])
-      except:
-        print >>sys.stderr, "autotrace_cmd: " + ' '.join(autotrace_cmd + [fp.name])
-        print >>sys.stderr, "ERROR: no proper xml returned: '" + cand['svg'] + "'"
-        xml = inkex.etree.fromstring('<svg/>')          # empty dummy
-
-      p_len,p_seg,p_pts = 0,0,0
-      for p in xml.findall('path'):
-        pstat = svg_pathstats(p.attrib['d'])
-        p_len += pstat['length']
-        p_seg += pstat['segments']
-        p_pts += pstat['points']
-      cand['length']   = p_len
-      cand['segments'] = p_seg
-      cand['points']   = p_pts
-
-      if cand['mean'] > 127:
-        cand['mean'] = 255 - cand['mean']	# should not happen
-      blackpixels = cand['img_width'] * cand['img_height'] * cand['mean'] / 255.
-      cand['strokewidth'] = blackpixels / max(cand['length'],1.0)
+    def score_candidate(i, traced):
+      """ score the path data of candidate i as soon as it arrives. Only the path data
+          of the best candidate so far is kept.
+      """
+      if traced is None:
+        timed_out[0] += 1
+        return
+      # M36 15C37.9219 18.1496 41.7926 19.6686 43.2585 23.1042C47.9556 34.1128 39.524 32.0995 35.179 37.6034C32.6296 40.8328 34 48.1105 34 52M36 17C32.075 22.4565 31.8375 30.074 35 36M74 42L46 38C45.9991 46.1415 46.7299 56.0825 45.6319 64C44.1349 74.7955 23.7094 77.5566 16.044 72.3966C7.27363 66.4928 8.04426 45.0047 16.2276 38.7384C20.6362 35.3626 27.7809 36.0006 33 36M44 37L45 37
+      path_d, pstat = traced
+      if pstat is None:
+        with timing.span('score', candidate=i):
+          pstat = svg_pathstats(path_d)
+      bitmap = below[thresholds[i]]
+      cand = Candidate(thresholds[i], bitmap, im.size[0]*search_scale, im.size[1]*search_scale, im_mean,
+                       pstat['length'] * search_scale, pstat['segments'], pstat['points'])
       candidate[i] = cand
+      keep_best(i, path_d)
+      for j in batch_dups.pop(bitmap, []):
+        candidate[j] = cand.with_threshold(thresholds[j])
+        keep_best(j, path_d)
 
     def calc_weight(cand, idx):
-      offset = (num_attempts/2.-idx) * (num_attempts/2.-idx) * (cand['img_width']+cand['img_height'])
-      w = cand['length']*5 - offset*.005 - cand['points']*.2 - cand['segments']*20
-      # print "calc_weight(%d) = rl=%f o=%f p=%f s=%f -> w=%f" % (idx, cand['length']*5, offset*.005, cand['points']*.2, cand['segments']*20, w)
+      offset = (num_attempts/2.-idx) * (num_attempts/2.-idx) * (cand.img_width+cand.img_height)
+      w = cand.length*5 - offset*.005 - cand.points*.2 - cand.segments*20
+      # print "calc_weight(%d) = rl=%f o=%f p=%f s=%f -> w=%f" % (idx, cand.length*5, offset*.005, cand.points*.2, cand.segments*20, w)
       return w
 
-    best_weight_idx = 0
-    for n in candidate.keys():
-      # print "candidate ", n
-      c = candidate[n]
-      # print "\t mean=%d len=%d seg=%d width=%d" % (c['mean'], c['length'], c['segments'], c['strokewidth'])
-      if calc_weight(c,n) > calc_weight(candidate[best_weight_idx], best_weight_idx):
-        best_weight_idx = n
+    def weight(i):
+      if i not in candidate:
+        return float('-inf')            # killed by a timeout.
+      return calc_weight(candidate[i], i)
+
+    # the best candidate so far and its path data. Ties go to the lower index, so that the
+    # result does not depend on the order in which the candidates complete.
+    best_trace = { 'index': None, 'bitmap': None, 'path_d': None }
+
+    def keep_best(i, path_d):
+      """ make candidate i the best, if it beats the best so far. path_d is its path data,
+          or None for a duplicate of a bitmap, whose path data was already dropped.
+      """
+      b = best_trace['index']
+      if b is not None and (weight(i), -i) <= (weight(b), -b):
+        return
+      if path_d is None and candidate[i].bitmap == best_trace['bitmap']:
+        path_d = best_trace['path_d']
+      best_trace.update(index=i, bitmap=candidate[i].bitmap, path_d=path_d)
+
+    def prerank(k):
+      """ estimate the weight of all candidates from raster statistics of their bitmaps,
+          and return the k best indices. Plainly unusable bitmaps are never returned.
+      """
+      pixels = numpy.asarray(im)
+      est = []
+      for i in range(num_attempts):
+        st = bitmap_proxy_stats(pixels < thresholds[i])
+        if st is None: continue
+        cand = Candidate(thresholds[i], None, im.size[0]*search_scale, im.size[1]*search_scale, 0,
+                         st['length']*search_scale, st['segments'], st['points'])
+        est.append((-calc_weight(cand, i), i))
+      est.sort()
+      if debug: print >>self.tty, "prerank: " + str([ (i, -w) for w,i in est ])
+      return [ i for w,i in est[:k] ]
+
+    # autotrace runs are independent subprocesses. We wait for them in a pool of threads,
+    # and score each one as soon as it completes. The order of completion does not matter,
+    # as keep_best() breaks ties by index.
+    # Pbm files (if any) go to a scratch directory, that we remove in any case, except when debugging.
+    num_workers = min(self.workers, num_attempts)
+    pool = None
+    if num_workers > 1:
+      pool = ThreadPool(num_workers)
+    scratch_dir = None
+    if backend.needs_scratch_dir:
+      scratch_dir = tempfile.mkdtemp(prefix="centerlinetrace", dir=self.scratch_tempdir())
+
+    runs = [0]                  # number of autotrace runs. A list, so that trace_batch() can update it.
+    timed_out = [0]             # number of runs killed by a timeout, or not started after the time limit.
+
+    def trace_batch(indices):
+      """ trace all indices that were not yet traced. Returns the best of indices.
+      """
+      todo = []
+      batch_dups.clear()
+      for i in sorted(set([i for i in indices if 0 <= i < num_attempts and i not in candidate])):
+        if below[thresholds[i]] not in bitmap_traced:
+          bitmap_traced[below[thresholds[i]]] = i
+          todo.append(i)
+        elif bitmap_traced[below[thresholds[i]]] in todo:
+          batch_dups.setdefault(below[thresholds[i]], []).append(i)
+      if pool is not None and len(todo) > 1:
+        for i, traced in pool.imap_unordered(trace_candidate, todo):
+          score_candidate(i, traced)
+      else:
+        for i in todo:
+          score_candidate(*trace_candidate(i))
+      runs[0] += len(todo)
+
+      # candidates with a duplicate bitmap of an earlier batch reuse the score of the traced one.
+      for i in indices:
+        if 0 <= i < num_attempts and i not in candidate and bitmap_traced[below[thresholds[i]]] in candidate:
+          candidate[i] = candidate[bitmap_traced[below[thresholds[i]]]].with_threshold(thresholds[i])
+          keep_best(i, None)
+      best = None
+      for i in sorted(set(indices)):
+        if i in candidate and (best is None or weight(i) > weight(best)):
+          best = i
+      return best
+
+    search_start = time.time()
+    try:
+      if self.search == 'golden' and num_attempts > 3:
+        # golden-section search for the maximum weight. Expects a unimodal weight function.
+        invphi = (math.sqrt(5) - 1) / 2
+        a, b = 0, num_attempts-1
+        while b - a > 2:
+          c = int(round(b - invphi * (b - a)))
+          d = int(round(a + invphi * (b - a)))
+          if d <= c: d = c + 1
+          trace_batch([c, d])
+          if weight(c) >= weight(d):
+            b = d
+          else:
+            a = c
+        trace_batch(range(a, b+1))
+      elif self.search == 'refine' and num_attempts > 3:
+        # coarse grid, then walk uphill from the best grid point, halving the step until nothing improves.
+        step = max(2, int(math.sqrt(num_attempts)))
+        best = trace_batch(range(step/2, num_attempts, step))
+        step = step/2
+        while step >= 1 and best is not None:
+          new_best = trace_batch([best-step, best, best+step])
+          if new_best == best:
+            step = step/2
+          best = new_best
+      elif self.prerank > 0 and num_attempts > self.prerank and numpy is not None:
+        with timing.span('prerank', k=self.prerank):
+          ranked = prerank(self.prerank)
+        trace_batch(ranked)
+      else:
+        trace_batch(range(num_attempts))
+    finally:
+      if pool is not None:
+        pool.terminate()
+      if scratch_dir is not None and not debug:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+      timing.add('search', search_start, time.time() - search_start,
+                 { 'search': self.search, 'candidates': num_attempts, 'runs': runs[0], 'timed_out': timed_out[0] })
+
+    if debug and runs[0] < num_attempts:
+      print >>self.tty, "search=%s: traced %d of %d candidates, %d autotrace runs saved." % (self.search, runs[0], num_attempts, num_attempts-runs[0])
+
+    best_weight_idx = best_trace['index']
+
+    if timed_out[0]:
+      print >>sys.stderr, "Time limit: %d of %d autotrace runs finished in time, using the best of them." % (runs[0]-timed_out[0], runs[0])
+      cache_key = None                  # not the result that more time would give.
+    if best_weight_idx is None:
+      return ( '', 1, im_size )
 
     if debug: print >>self.tty, "best: %d/%d" % (best_weight_idx, num_attempts)
     ## if standalone:
-    # svg = re.sub('stroke:', (stroke_style_add % candidate[best_weight_idx]['strokewidth']) + ' stroke:', candidate[best_weight_idx]['svg'])
+    # svg = re.sub('stroke:', (stroke_style_add % candidate[best_weight_idx].strokewidth) + ' stroke:', svg)
     # return svg
 
     ## inkscape-extension:
-    return ( candidate[best_weight_idx]['svg'], candidate[best_weight_idx]['strokewidth'], orig_im_size )
-
+    cand = candidate[best_weight_idx]
+    if im_full is not None:
+      with timing.span('tiles', size=im_full.size):
+        path_d = self.trace_tiles(backend, im_full, cand.threshold)
+      result = ( path_d, cand.strokewidth * im_full.size[0] / float(im.size[0]), im_size )
+      if self.deadline is not None and time.time() >= self.deadline:
+        cache_key = None                # some tiles may be missing.
+    elif im_pyramid is not None:
+      lut = [ 255 for n in range(cand.threshold) ] + [ 0 for n in range(cand.threshold,256) ]
+      with timing.span('bitmap', size=im_pyramid.size, threshold=cand.threshold):
+        bw = im_pyramid.point(lut, mode='1')
+      try:
+        path_d, pstat = self.trace_once(backend, bw, "centerlinetrace_full")
+        blackpixels = im_pyramid.size[0] * im_pyramid.size[1] * cand.mean / 255.
+        result = ( path_d, blackpixels / max(self.path_length(path_d, pstat), 1.0), im_size )
+      except TraceTimeout as e:
+        # the low resolution trace is better than nothing.
+        print >>sys.stderr, "Time limit: %s. Using the trace at 1/%g of the size." % (e, search_scale)
+        cache_key = None
+        result = ( best_trace['path_d'] or '', cand.strokewidth / search_scale,
+                   (im_size[0] / search_scale, im_size[1] / search_scale) )
+    else:
+      path_d = best_trace['path_d']
+      if path_d is None:
+        # the best is a duplicate bitmap of a candidate that lost in an earlier batch, its path data was dropped.
+        lut = [ 255 for n in range(cand.threshold) ] + [ 0 for n in range(cand.threshold,256) ]
+        try:
+          path_d, pstat = self.trace_once(backend, im.point(lut, mode='1'), "centerlinetrace_%03d" % best_weight_idx)
+        except TraceTimeout as e:
+          print >>sys.stderr, "Time limit: %s. The best candidate was not traced again." % e
+          cache_key = None
+          path_d = ''
+      result = ( path_d, cand.strokewidth, im_size )
+    if self.preview:
+      self.preview_size_store(image_file, cliprect, time.time() - trace_start, im_scale > 1.0)
+    if cache_key is not None:
+      with timing.span('cache-store'):
+        self.cache_store(cache_key, result)
+    return result
+
+
+  def trace_adaptive(self, backend, im, tiled, im_size):
+    """ trace a single bitmap made with a local mean threshold (see adaptive_bitmap),
+        instead of searching a global threshold. Returns (path_d, strokewidth, im_size)
+        like svg_centerline_trace.
+    """
+    timing = self.timing
+    if tiled:
+      # each tile is thresholded on its own, from its part of the image with a margin of window/2.
+      # The full size image never has a bitmap or summed-area table, which would not fit into memory.
+      window = adaptive_window(im.size, self.adaptive_window)
+      blacks = {}                       # core -> black pixels in it.
+
+      def bitmap(crop, core):
+        with timing.span('adaptive-bitmap', size=(crop[2]-crop[0], crop[3]-crop[1]), window=window):
+          bw, black, dummy = adaptive_bitmap(im, window, self.adaptive_offset, self.adaptive_smooth, crop)
+        dark = numpy.asarray(bw)[core[1]-crop[1]:core[3]-crop[1], core[0]-crop[0]:core[2]-crop[0]]
+        blacks[core] = int(numpy.count_nonzero(dark))
+        return bw
+
+      with timing.span('tiles', size=im.size):
+        path_d = self.trace_tiles(backend, im, None, bitmap, max(window // 2, self.adaptive_smooth))
+      black = sum(blacks.values())
+      if debug: print >>self.tty, "adaptive threshold: window=%d offset=%g black=%d" % (window, self.adaptive_offset, black)
+      return ( path_d, black / max(self.path_length(path_d), 1.0), im_size )
+
+    with timing.span('adaptive-bitmap', size=im.size) as span:
+      bw, black, window = adaptive_bitmap(im, self.adaptive_window, self.adaptive_offset, self.adaptive_smooth)
+      span.set(window=window, black=black)
+    if debug: print >>self.tty, "adaptive threshold: window=%d offset=%g black=%d" % (window, self.adaptive_offset, black)
+    if self.options.debug: bw.show()
+    path_d, pstat = self.trace_once(backend, bw, "centerlinetrace_adaptive")
+    return ( path_d, black / max(self.path_length(path_d, pstat), 1.0), im_size )
+
+  def trace_once(self, backend, bw, name):
+    """ trace the bi-level image bw, with a scratch directory of its own.
+        Returns (path_d, pstat) as backend.trace_path() does.
+    """
+    scratch_dir = None
+    if backend.needs_scratch_dir:
+      scratch_dir = tempfile.mkdtemp(prefix="centerlinetrace", dir=self.scratch_tempdir())
+    try:
+      with self.timing.span('trace', size=bw.size, backend=self.backend):
+        return backend.trace_path(bw, scratch_dir, name)
+    finally:
+      if scratch_dir is not None and not debug:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+  def path_length(self, path_d, pstat=None):
+    """ the total length of path_d, as svg_pathstats() measures it. pstat are its statistics, if known. """
+    if pstat is not None:
+      return pstat['length']
+    with self.timing.span('score'):
+      return svg_pathstats(path_d)['length']
+
+  def rof_denoise(self, im, strength):
+    """ total variation (ROF) denoising of a grayscale image, see rof.py.
+        Unlike the median filter, edges stay sharp and thin lines are not eaten.
+        strength 1..9 is mapped to a tv_weight of 8..72 on the 0..255 gray scale.
+        The solver warm starts from half resolution, and stops after rof_time seconds.
+        Returns (im, iterations).
+    """
+    import rof
+    u, iterations = rof.denoise_pyramid(numpy.asarray(im, dtype=numpy.float32), tv_weight=8.0*strength,
+                                        max_iterations=self.rof_max_iterations, time_budget=self.rof_time)
+    numpy.clip(u, 0, 255, out=u)
+    u += 0.5
+    return (Image.fromarray(u.astype(numpy.uint8), 'L'), iterations)
 
   def calc_unit_factor(self, units='mm'):
         """ return the scale factor for all dimension conversions.
@@ -413,20 +1590,148 @@ class TraceCenterline(inkex.Effect):
         self.unit_factor = 1.0 / dialog_units
         return self.unit_factor
 
-  def effect(self):
-    global debug
-
-    if self.options.version:
-      print __version__
-      sys.exit(0)
+  def apply_options(self):
+    """ copy the parsed command line options into the tracing parameters.
+    """
     if self.options.invert         is not None: self.invert_image       = self.options.invert
     if self.options.remove         is not None: self.replace_image      = self.options.remove
     if self.options.megapixels     is not None: self.megapixel_limit    = self.options.megapixels
     if self.options.candidates     is not None: self.candidates         = self.options.candidates
     if self.options.despecle       is not None: self.filter_median      = self.options.despecle
+    if self.options.despecle_mode  is not None: self.despecle_mode      = self.options.despecle_mode
+    if self.options.threshold_mode is not None: self.threshold_mode     = self.options.threshold_mode
+    if self.options.adaptive_window is not None: self.adaptive_window   = self.options.adaptive_window
+    if self.options.adaptive_offset is not None: self.adaptive_offset   = self.options.adaptive_offset
+    if self.options.rof_time       is not None: self.rof_time           = self.options.rof_time
     if self.options.equal_light    is not None: self.filter_equal_light = self.options.equal_light
     if self.options.hairline       is not None: self.hairline           = self.options.hairline
     if self.options.hairline_width is not None: self.hairline_width     = self.options.hairline_width
+    if self.options.workers        is not None: self.workers            = self.options.workers
+    if self.options.at_input       is not None: self.autotrace_input    = self.options.at_input
+    if self.options.search         is not None: self.search             = self.options.search
+    if self.options.backend        is not None: self.backend            = self.options.backend
+    if self.options.time_limit     is not None: self.time_limit         = self.options.time_limit
+    if self.options.candidate_timeout is not None: self.candidate_timeout = self.options.candidate_timeout
+    if self.options.at_memory_limit is not None: self.at_memory_limit   = self.options.at_memory_limit
+    if self.options.prerank        is not None: self.prerank            = self.options.prerank
+    if self.options.tiles          is not None: self.tiles              = self.options.tiles
+    if self.options.pyramid        is not None: self.pyramid            = self.options.pyramid
+    if self.options.tile_overlap   is not None: self.tile_overlap       = self.options.tile_overlap
+    if self.options.memory_limit   is not None: self.memory_limit       = self.options.memory_limit
+    if self.options.cache_size     is not None: self.cache_size         = self.options.cache_size
+    if self.options.cache_dir      is not None: self.cache_dir          = self.options.cache_dir
+    if self.options.timing_file    is not None: self.timing_file        = self.options.timing_file
+    if self.options.timing_format  is not None: self.timing_format      = self.options.timing_format
+    if self.options.preview        is not None: self.preview            = self.options.preview
+    if self.options.preview_time   is not None: self.preview_time       = self.options.preview_time
+    if self.options.join_tolerance is not None: self.join_tolerance     = self.options.join_tolerance
+    if self.options.order          is not None: self.order              = self.options.order
+    if self.options.compact        is not None: self.compact            = self.options.compact
+    if self.options.precision      is not None: self.precision          = self.options.precision
+    if self.options.compact_tolerance is not None: self.compact_tolerance = self.options.compact_tolerance
+    if not self.options.cache: self.cache_size = 0
+    self.timing.enabled = bool(self.timing_file)
+    if self.workers < 1:
+      try:
+        self.workers = multiprocessing.cpu_count()
+      except NotImplementedError:
+        self.workers = 1
+    if self.backend == 'libautotrace':
+      import centerline_libautotrace
+      if centerline_libautotrace.load() is None:
+        if debug: LibautotraceBackend.note_missing(self.tty, self.cache_dir if self.cache_size > 0 else None)
+        self.backend = 'autotrace'
+    if self.backend == 'autotrace': AutotraceBackend.check(self.cache_dir if self.cache_size > 0 else None)
+    if self.preview:
+      # one trace of a small proxy image: the candidate that looks best from its bitmap (see prerank()).
+      # the proxy size is chosen per image, see preview_megapixels().
+      self.preview_limit = self.megapixel_limit
+      self.tiles = False
+      self.search = 'sweep'
+      self.prerank = 1
+
+  def trace_timeout(self):
+    """ the seconds that a trace run may take from now, by candidate_timeout and the deadline.
+        Returns None for no limit. Raises TraceTimeout if the deadline has passed.
+    """
+    timeout = None
+    if self.candidate_timeout > 0:
+      timeout = self.candidate_timeout
+    if self.deadline is not None:
+      left = self.deadline - time.time()
+      if left <= 0:
+        raise TraceTimeout("time limit of %gs reached" % self.time_limit)
+      timeout = left if timeout is None else min(timeout, left)
+    return timeout
+
+  def preview_megapixels(self, image_file, cliprect=None):
+    """ the size of the preview proxy of an image, so that tracing it takes about preview_time seconds.
+        Each image keeps its proxy size from one preview to the next, so that the preprocessed proxy
+        is reused when only the autotrace options change. The size is halved while the last trace took
+        more than 1.5 times preview_time, and doubled if it took less than a third and the image was
+        scaled down. Sizes are 0.01 megapixels times a power of two, at most preview_limit.
+    """
+    mp = 0.16
+    try:
+      entry = self.preview_sizes_load()[self.preview_id(image_file, cliprect)]
+      mp, seconds, scaled = float(entry['megapixels']), float(entry['seconds']), entry['scaled']
+      while seconds > 1.5 * self.preview_time and mp > 0.01:
+        mp, seconds = mp / 2., seconds / 2.
+      if seconds * 3 < self.preview_time and scaled:
+        mp *= 2
+    except (KeyError, TypeError, ValueError):
+      pass                      # a new image.
+    mp = 0.01 * 2 ** max(0, int(round(math.log(max(mp, 0.01) / 0.01, 2))))
+    return min(mp, self.preview_limit)
+
+  def preview_id(self, image_file, cliprect):
+    """ a hash over the image source and the cliprect, but not its mtime: an edited image keeps its proxy size. """
+    h = hashlib.sha1()
+    self.image_source_hash(h, image_file)
+    if cliprect is not None:
+      cliprect = tuple([ cliprect[k] for k in ('x', 'y', 'w', 'h') ])
+    h.update(repr(cliprect))
+    return h.hexdigest()
+
+  def preview_sizes_load(self):
+    """ the dict of preview_id() -> proxy size and trace time of the last preview, from cache_dir. """
+    try:
+      sizes = json.load(open(os.path.join(self.cache_dir, 'preview.sizes')))
+    except (IOError, OSError, ValueError):
+      return {}
+    if not isinstance(sizes, dict):
+      return {}
+    return sizes
+
+  def preview_size_store(self, image_file, cliprect, seconds, scaled):
+    """ remember that the preview trace of an image at megapixel_limit took seconds, for preview_megapixels().
+        scaled is True, if the image was larger than the proxy. Only the most recent images are kept.
+    """
+    if self.cache_size <= 0:
+      return
+    sizes = self.preview_sizes_load()
+    sizes[self.preview_id(image_file, cliprect)] = { 'megapixels': self.megapixel_limit, 'seconds': seconds,
+                                                      'scaled': scaled, 'time': time.time() }
+    for key in sorted(sizes, key=lambda k: sizes[k].get('time', 0))[:-self.preview_sizes_kept]:
+      del sizes[key]
+    try:
+      if not os.path.isdir(self.cache_dir):
+        os.makedirs(self.cache_dir)
+      fd,tmpname = tempfile.mkstemp(prefix='.centerlinetrace', dir=self.cache_dir)
+      os.write(fd, json.dumps(sizes))
+      os.close(fd)
+      os.rename(tmpname, os.path.join(self.cache_dir, 'preview.sizes'))
+    except (IOError, OSError):
+      pass
+
+  def effect(self):
+    global debug
+
+    if self.options.version:
+      print __version__
+      sys.exit(0)
+    effect_start = time.time()
+    self.apply_options()
     # if self.options.debug          is not None: debug                   = self.options.debug
     # self.options.debug = True
 
@@ -456,13 +1761,19 @@ class TraceCenterline(inkex.Effect):
       inkex.errormsg(_("Please select an image. Only a cliprect was selected."))
       return
 
-    for id, node in self.selected.iteritems():
+    # collect the images in selection order, so that the paths are always stacked the same way.
+    images = []         # (node, svg_x_off, svg_y_off, svg_img_w, svg_img_h)
+    jobs = []           # (index, href, cliprect) for trace_image()
+    for id in self.options.ids:
+      node = self.selected.get(id)
+      if node is None:
+        continue
       if debug: print >>self.tty, "id="+str(id), "tag="+str(node.tag)
       if self.options.cliprect and node.tag == inkex.addNS('rect','svg'):
         continue
       if node.tag != inkex.addNS('image','svg'):
         inkex.errormsg(_("Object "+id+" is NOT an image. seen:"+str(node.tag)+" expected:"+inkex.addNS('image','svg')+"\n Try - Object->Ungroup"))
-        return
+        continue
 
       # images can also just have a transform attribute, and no x or y,
       # FIXME: should find the image transformation!
@@ -471,14 +1782,15 @@ class TraceCenterline(inkex.Effect):
       svg_y_off = float(node.get('y', 0))
       svg_img_w = float(node.get('width',  0.001))
       svg_img_h = float(node.get('height', 0.001))
+      clip = None
       if cliprect is not None:
         # normalize cliprect into range 0..1
-        cliprect['x'] = cliprect['x'] - svg_x_off
-        cliprect['y'] = cliprect['y'] - svg_y_off
-        cliprect['x'] = cliprect['x'] / svg_img_w
-        cliprect['y'] = cliprect['y'] / svg_img_h
-        cliprect['w'] = cliprect['w'] / svg_img_w
-        cliprect['h'] = cliprect['h'] / svg_img_h
+        clip = {
+          'x': (cliprect['x'] - svg_x_off) / svg_img_w,
+          'y': (cliprect['y'] - svg_y_off) / svg_img_h,
+          'w': cliprect['w'] / svg_img_w,
+          'h': cliprect['h'] / svg_img_h
+        }
 
       # handle two cases. Embedded and linked images
       # <image .. xlink:href="data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAT8AA ..." preserveAspectRatio="none" height="432" width="425" transform="matrix(1,0,-0.52013328,0.85408511,0,0)"/>
@@ -497,33 +1809,47 @@ class TraceCenterline(inkex.Effect):
       #
       # ######################
 
-      if href[:7] == 'file://':
-        filename=href[7:]
-        if debug: print >>self.tty, "linked image: ="+filename
-      elif href[0] == '/' or href[0] == '.':
-        filename=href
-        if debug: print >>self.tty, "linked image path: ="+filename
-      elif href[:11] == 'data:image/':
-        l = href[11:].index(';')
-        type = href[11:11+l]			# 'png' 'jpeg'
-        if debug: print >>self.tty, "embedded image: "+href[:11+l]
-        img=base64.decodestring(href[11+l+8:])
-        f=tempfile.NamedTemporaryFile(mode="wb", prefix='centerlinetrace', suffix="."+type, delete=False)
-        f.write(img)
-        filename=f.name
-        f.close()
-      else:
-        inkex.errormsg(_("Neither file:// nor data:image/; prefix. Cannot parse PNG/JPEG image href "+href[:200]+"..."))
-        sys.exit(1)
-      if debug: print >>self.tty, "filename="+filename
-      #
-      path_svg,stroke_width,im_size = self.svg_centerline_trace(filename, cliprect)
-      xml = inkex.etree.fromstring(path_svg)
+      images.append((node, svg_x_off, svg_y_off, svg_img_w, svg_img_h))
+      jobs.append((len(jobs), href, clip))
+
+    if not jobs:
+      return
+
+    # one image per process. Without fork() (windows) each process would have to reimport
+    # everything, so there we trace one after the other.
+    try:
+      cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+      cpus = 1
+    processes = self.options.processes
+    if processes < 1:
+      processes = cpus
+    processes = min(processes, len(jobs))
+    if sys_platform.startswith('win'):
+      processes = 1
+    if self.options.workers < 1:
+      # share the CPUs between the processes and their candidate runs.
+      self.workers = max(1, cpus // processes)
+    if processes > 1:
+      if debug: print >>self.tty, "tracing %d images, %d in parallel" % (len(jobs), processes)
+      pool = multiprocessing.Pool(processes, init_image_worker, (self.options, self.workers))
       try:
-        path_d=xml.find('path').attrib['d']
-      except:
-        inkex.errormsg(_("Couldn't trace the path. Please make sure that the checkbox for tracing bright lines is set correctly and that your drawing has enough contrast."))
-        sys.exit(1)
+        results = []
+        for res, events in pool.map(trace_image_job, jobs):
+          results.append(res)
+          self.timing.extend(events)
+        pool.close()
+      finally:
+        pool.terminate()
+    else:
+      results = map(self.trace_image, jobs)
+
+    insert_start = time.time()
+    replaced = False
+    for (i, path_d, stroke_width, im_size, err), (node, svg_x_off, svg_y_off, svg_img_w, svg_img_h) in zip(results, images):
+      if err is not None:
+        inkex.errormsg(_("Image "+str(node.get('id'))+": "+err))
+        continue
 
       sx = svg_img_w/im_size[0]
       sy = svg_img_h/im_size[1]
@@ -538,9 +1864,6 @@ class TraceCenterline(inkex.Effect):
         svg_y_off = max(svg_y_off, float(cliprect['node'].get('y', 0)))
       matrix = "translate(%g,%g) scale(%g,%g)" % (svg_x_off, svg_y_off, sx, sy)
       #
-      if href[:5] == 'data:':
-        os.unlink(filename) ## it was a temporary file (representing an embedded image).
-      #
       # Create SVG Path
       if self.hairline:
         stroke_width = self.hairline_width * 96. / 25.4         # mm2px FIXME: 96dpi is just a default guess.
@@ -548,15 +1871,134 @@ class TraceCenterline(inkex.Effect):
         stroke_width = stroke_width * 0.5 * (abs(sx) + abs(sy))
       style = { 'stroke': '#000000', 'fill': 'none', 'stroke-linecap': 'round', 'stroke-width': stroke_width }
       if self.invert_image: style['stroke'] = '#777777'
+      import simplestyle
       path_attr = { 'style': simplestyle.formatStyle(style), 'd': path_d, 'transform': matrix }
       ## insert the new path object
       inkex.etree.SubElement(self.current_layer, inkex.addNS('path', 'svg'), path_attr)
       ## delete the old image object
       if self.replace_image:
         node.getparent().remove(node)
-        if cliprect is not None:        # and its cliprect ...
-          cliprect['node'].getparent().remove(cliprect['node'])
-
+        replaced = True
+    if replaced and cliprect is not None:        # and its cliprect ...
+      cliprect['node'].getparent().remove(cliprect['node'])
+
+    if self.timing.enabled:
+      now = time.time()
+      self.timing.add('insert', insert_start, now - insert_start, { 'paths': len(results) })
+      self.timing.add('effect', effect_start, now - effect_start, { 'images': len(jobs), 'processes': processes })
+      self.write_timing()
+
+  def write_timing(self):
+    """ write the recorded spans to the timing file. """
+    meta = { 'version': __version__, 'argv': sys.argv[1:], 'start': time.strftime('%Y-%m-%d %H:%M:%S'),
+             'backend': self.backend, 'search': self.search, 'candidates': self.candidates,
+             'megapixels': self.megapixel_limit, 'workers': self.workers }
+    try:
+      name = self.timing.write(self.timing_file, self.timing_format, meta)
+      if debug: print >>self.tty, "timing written to " + name
+    except (IOError, OSError) as e:
+      print >>sys.stderr, "Warning: cannot write timing file: " + str(e)
+
+  def image_source(self, href):
+    """ a file name, or an in-memory file with the data of an embedded image, for Image.open().
+        Returns None if href is neither.
+    """
+    if href[:7] == 'file://':
+      filename=href[7:]
+      if debug: print >>self.tty, "linked image: ="+filename
+    elif href[0] == '/' or href[0] == '.':
+      filename=href
+      if debug: print >>self.tty, "linked image path: ="+filename
+    elif href[:11] == 'data:image/':
+      l = href.index(',', 11)
+      if debug: print >>self.tty, "embedded image: "+href[:l]
+      # decode straight from a buffer into memory, without slicing off a copy of the payload.
+      # PIL reads the image from the BytesIO, no temporary file is needed.
+      with self.timing.span('base64', bytes=len(href)-l-1):
+        filename=io.BytesIO(binascii.a2b_base64(buffer(href, l+1)))
+    else:
+      return None
+    if debug: print >>self.tty, "filename="+str(filename)
+    return filename
+
+  def trace_image(self, job):
+    """ trace one image. job is a tuple (index, href, cliprect) as prepared by effect().
+        Errors are returned, not raised, so that they only affect this image.
+        Returns (index, path_d, stroke_width, im_size, error message or None).
+    """
+    i, href, cliprect = job
+    try:
+      filename = self.image_source(href)
+      if filename is None:
+        return (i, None, None, None, "Neither file:// nor data:image/; prefix. Cannot parse PNG/JPEG image href "+href[:200]+"...")
+      with self.timing.span('image', index=i):
+        path_d,stroke_width,im_size = self.svg_centerline_trace(filename, cliprect)
+      if not path_d:
+        return (i, None, None, None, "Couldn't trace the path. Please make sure that the checkbox for tracing bright lines is set correctly and that your drawing has enough contrast.")
+      path_d = self.postprocess_path(path_d)
+    except SystemExit:
+      return (i, None, None, None, "Tracing aborted.")
+    except Exception as e:
+      return (i, None, None, None, "%s: %s" % (e.__class__.__name__, e))
+    return (i, path_d, stroke_width, im_size, None)
+
+  def postprocess_path(self, path_d):
+    """ the path data as it goes into the document: subpaths joined within self.join_tolerance pixels,
+        ordered for short pen-up moves with self.order, and compacted with self.compact.
+        Compacting rounds to self.precision decimals, writes relative commands, and merges
+        straight runs within self.compact_tolerance pixels.
+        Returned unchanged if all of this is off, or if it has commands that centerline_paths does not know.
+    """
+    if not (self.join_tolerance > 0 or self.order or self.compact):
+      return path_d
+    try:
+      subpaths = centerline_paths.path_parse(path_d)
+    except ValueError as e:
+      print >>sys.stderr, "Warning: path data not post-processed: " + str(e)
+      return path_d
+
+    if self.join_tolerance > 0 or self.order:
+      nsubs = len(subpaths)
+      travel = centerline_paths.path_travel(subpaths)
+      if self.join_tolerance > 0:
+        with self.timing.span('join', subpaths=nsubs) as span:
+          subpaths = centerline_paths.subpaths_join(subpaths, self.join_tolerance)
+          span.set(joined_subpaths=len(subpaths))
+      if self.order:
+        with self.timing.span('order', subpaths=len(subpaths)) as span:
+          subpaths = centerline_paths.subpaths_order(subpaths)
+          span.set(travel=travel, ordered_travel=centerline_paths.path_travel(subpaths))
+      if debug: print >>self.tty, "pen-up moves shortened from %.0f to %.0f px, %d to %d subpaths" % (
+            travel, centerline_paths.path_travel(subpaths), nsubs, len(subpaths))
+
+    if not self.compact:
+      return centerline_paths.path_format(subpaths)
+    with self.timing.span('compact', bytes=len(path_d)) as span:
+      nsegs = sum([ len(sub[1]) for sub in subpaths ])
+      if self.compact_tolerance > 0:
+        subpaths = [ centerline_paths.subpath_simplify(sub, self.compact_tolerance) for sub in subpaths ]
+      compact_d = centerline_paths.path_format_compact(subpaths, max(0, self.precision))
+      span.set(compact_bytes=len(compact_d), segments=nsegs, compact_segments=sum([ len(sub[1]) for sub in subpaths ]))
+    if debug: print >>self.tty, "path data compacted from %d to %d bytes (%.0f%%), %d to %d segments" % (
+          len(path_d), len(compact_d), 100. * len(compact_d) / max(len(path_d), 1),
+          nsegs, sum([ len(sub[1]) for sub in subpaths ]))
+    return compact_d
+
+image_tracer = None     # the TraceCenterline instance of an image worker process.
+
+def init_image_worker(options, workers):
+  """ Pool initializer: a TraceCenterline in each worker process, with the options of the parent.
+  """
+  global image_tracer
+  image_tracer = TraceCenterline()
+  image_tracer.options = options
+  image_tracer.options.workers = workers
+  image_tracer.apply_options()
+
+def trace_image_job(job):
+  """ Returns the result of trace_image() and the timing spans recorded for it. """
+  res = image_tracer.trace_image(job)
+  return (res, image_tracer.timing.pop_events())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,170 @@
+#
+# In-process autotrace through ctypes, for centerline-trace.py
+# (C) 2016-2019 juewei@fabmail.org and contributors.
+# Distribute under GPL-2.0 or ask.
+#
+# This is the 'libautotrace' backend of centerline-trace.py. It calls the fitting
+# API of the autotrace shared library directly on the bitmap in memory:
+#
+#   at_bitmap_new()  ->  at_splines_new()  ->  spline lists  ->  path data and statistics
+#
+# No process is started, no pbm file is written, and no svg text is written or parsed.
+# The path data is the same as in 'autotrace --centerline --output-format=svg', and the
+# statistics are those of svg_pathstats() in centerline-trace.py, taken from the spline arrays.
+#
+# at_splines_new() is not reentrant, it runs under a global lock. Traces in worker threads
+# therefore run one at a time, only the bitmaps and the scoring of the candidates overlap.
+# Run the autotrace program for parallel traces.
+#
+# The structures below follow autotrace.h of autotrace 0.31.1 and 0.40.0.
+# load() returns None if the library cannot be found or lacks the functions,
+# then the caller runs the autotrace program instead.
+#
+
+import ctypes, ctypes.util, threading, math
+
+at_real = ctypes.c_float
+at_bool = ctypes.c_int
+
+LINEARTYPE = 1          # at_polynomial_degree of a straight spline. All others are drawn as cubic.
+
+
+class at_color(ctypes.Structure):
+  _fields_ = [ ('r', ctypes.c_ubyte), ('g', ctypes.c_ubyte), ('b', ctypes.c_ubyte) ]
+
+class at_real_coord(ctypes.Structure):
+  _fields_ = [ ('x', at_real), ('y', at_real), ('z', at_real) ]
+
+class at_spline(ctypes.Structure):
+  _fields_ = [ ('v', at_real_coord * 4), ('degree', ctypes.c_int), ('linearity', at_real) ]
+
+class at_spline_list(ctypes.Structure):
+  _fields_ = [ ('data', ctypes.POINTER(at_spline)), ('length', ctypes.c_uint),
+               ('clockwise', at_bool), ('color', at_color), ('open', at_bool) ]
+
+class at_spline_list_array(ctypes.Structure):
+  _fields_ = [ ('data', ctypes.POINTER(at_spline_list)), ('length', ctypes.c_uint),
+               ('centerline', at_bool), ('preserve_width', at_bool), ('width_weight_factor', at_real),
+               ('background_color', ctypes.POINTER(at_color)) ]
+
+class at_fitting_opts(ctypes.Structure):
+  _fields_ = [ ('background_color', ctypes.POINTER(at_color)), ('color_count', ctypes.c_uint),
+               ('corner_always_threshold', at_real), ('corner_surround', ctypes.c_uint),
+               ('corner_threshold', at_real), ('error_threshold', at_real),
+               ('filter_iterations', ctypes.c_uint), ('line_reversion_threshold', at_real),
+               ('line_threshold', at_real), ('remove_adjacent_corners', at_bool),
+               ('tangent_surround', ctypes.c_uint), ('despeckle_level', ctypes.c_uint),
+               ('despeckle_tightness', at_real), ('noise_removal', at_real),
+               ('centerline', at_bool), ('preserve_width', at_bool), ('width_weight_factor', at_real) ]
+
+class at_bitmap(ctypes.Structure):
+  _fields_ = [ ('height', ctypes.c_ushort), ('width', ctypes.c_ushort),
+               ('bitmap', ctypes.POINTER(ctypes.c_ubyte)), ('np', ctypes.c_uint) ]
+
+
+_lib = []               # [ library or None ], once load() was called.
+_lock = threading.Lock()
+
+def load():
+  """ the autotrace shared library with argument and result types set, or None. """
+  if _lib:
+    return _lib[0]
+  lib = None
+  names = [ ctypes.util.find_library('autotrace'), 'libautotrace.so.3', 'libautotrace.so', 'libautotrace.dylib', 'autotrace.dll' ]
+  for name in names:
+    if not name:
+      continue
+    try:
+      lib = ctypes.CDLL(name)
+      lib.at_fitting_opts_new.restype = ctypes.POINTER(at_fitting_opts)
+      lib.at_fitting_opts_free.argtypes = [ ctypes.POINTER(at_fitting_opts) ]
+      lib.at_bitmap_new.restype = ctypes.POINTER(at_bitmap)
+      lib.at_bitmap_new.argtypes = [ ctypes.c_ushort, ctypes.c_ushort, ctypes.c_uint ]
+      lib.at_bitmap_free.argtypes = [ ctypes.POINTER(at_bitmap) ]
+      lib.at_splines_new.restype = ctypes.POINTER(at_spline_list_array)
+      lib.at_splines_new.argtypes = [ ctypes.POINTER(at_bitmap), ctypes.POINTER(at_fitting_opts), ctypes.c_void_p, ctypes.c_void_p ]
+      lib.at_splines_free.argtypes = [ ctypes.POINTER(at_spline_list_array) ]
+      break
+    except (OSError, AttributeError):
+      lib = None
+  _lib.append(lib)
+  return lib
+
+
+def splines_path(splines, height):
+  """ the svg path d attribute of an at_spline_list_array, like output-svg.c of autotrace writes it:
+      y upwards in the splines becomes y downwards in svg. White spline lists (background) are skipped.
+      Returns (path_d, pstat), where pstat has the points, segments and length of svg_pathstats():
+      curves are measured as straight lines through their handles.
+  """
+  d = []
+  points = 0
+  segments = 0
+  length = 0.0
+  for i in range(splines.length):
+    lst = splines.data[i]
+    if lst.length == 0 or (lst.color.r, lst.color.g, lst.color.b) == (255, 255, 255):
+      continue
+    v = lst.data[0].v
+    x0, y0 = v[0].x, v[0].y
+    d.append('M%g %g' % (x0, height - y0))
+    xs, ys = [ x0 ], [ y0 ]
+    for j in range(lst.length):
+      s = lst.data[j]
+      v = s.v
+      if s.degree == LINEARTYPE:
+        d.append('L%g %g' % (v[3].x, height - v[3].y))
+        xs.append(v[3].x); ys.append(v[3].y)
+      else:
+        d.append('C%g %g %g %g %g %g' % (v[1].x, height - v[1].y, v[2].x, height - v[2].y, v[3].x, height - v[3].y))
+        xs.extend((v[1].x, v[2].x, v[3].x)); ys.extend((v[1].y, v[2].y, v[3].y))
+    if not (splines.centerline or lst.open):
+      d.append('z')
+      xs.append(x0); ys.append(y0)
+    points += len(xs)
+    segments += 1
+    for k in range(1, len(xs)):
+      length += math.hypot(xs[k] - xs[k-1], ys[k] - ys[k-1])
+  return (''.join(d), { 'points':points, 'segments':segments, 'length':length })
+
+
+def trace_path(lib, pixels, width, height, error_threshold=2.0, filter_iterations=4):
+  """ trace width x height bytes of pixels (0 is black, 255 white) along the centerline.
+      Returns (path_d, pstat) as splines_path() does. Only the fitting holds the global lock,
+      the bitmap and the options of each trace are its own.
+  """
+  white = at_color(255, 255, 255)
+  opts = lib.at_fitting_opts_new()
+  bitmap = lib.at_bitmap_new(width, height, 1)
+  try:
+    opts.contents.centerline = 1
+    opts.contents.error_threshold = error_threshold
+    opts.contents.filter_iterations = filter_iterations
+    opts.contents.background_color = ctypes.pointer(white)
+    ctypes.memmove(bitmap.contents.bitmap, pixels, width * height)
+    _lock.acquire()
+    try:
+      splines = lib.at_splines_new(bitmap, opts, None, None)
+    finally:
+      _lock.release()
+    try:
+      if not splines:
+        return ('', { 'points':0, 'segments':0, 'length':0 })
+      return splines_path(splines.contents, height)
+    finally:
+      if splines:
+        lib.at_splines_free(splines)
+  finally:
+    opts.contents.background_color = None       # ours, at_fitting_opts_free() must not free it.
+    lib.at_fitting_opts_free(opts)
+    lib.at_bitmap_free(bitmap)
+
+
+def trace(lib, pixels, width, height, error_threshold=2.0, filter_iterations=4):
+  """ like trace_path(), but returns svg text in the format of 'autotrace --centerline --output-format=svg'.
+  """
+  d, pstat = trace_path(lib, pixels, width, height, error_threshold, filter_iterations)
+  svg = '<?xml version="1.0" standalone="yes"?>\n<svg width="%d" height="%d">\n' % (width, height)
+  if d:
+    svg += '<path style="stroke:#000000; fill:none;" d="%s"/>\n' % d
+  return svg + '</svg>\n'
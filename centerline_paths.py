@@ -0,0 +1,526 @@
+#
+# Path geometry helpers for centerline-trace.py
+# (C) 2016-2019 juewei@fabmail.org and contributors.
+# Distribute under GPL-2.0 or ask.
+#
+# Autotrace (and the built-in python backend) return one svg path with
+# absolute M, L, C and Z commands. Here such a path is handled as a list of
+# subpaths. Each subpath is a list
+#
+#   [ start, segments, closed ]
+#
+# where start is an [x, y] list, segments is a list of (cmd, coords) tuples
+# with cmd 'L' (coords [x, y]) or 'C' (coords [x1, y1, x2, y2, x, y]), and
+# closed is True if the subpath ends with a Z.
+#
+
+import re, math
+
+_path_token_re = re.compile('([MmLlCcZz])|([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?)')
+_path_nargs = { 'M':2, 'L':2, 'C':6, 'Z':0 }
+
+
+def path_parse(path_d):
+  """ parse an svg path d attribute with M, L, C, Z commands (absolute or relative)
+      into a list of subpaths. Raises ValueError on anything else.
+  """
+  subpaths = []
+  cmd = None
+  args = []
+  cur = [0., 0.]
+  sub = None
+
+  def flush():
+    if cmd is None or cmd.upper() == 'Z':
+      return
+    n = _path_nargs[cmd.upper()]
+    if len(args) % n:
+      raise ValueError("odd number of coordinates for '%s' in path" % cmd)
+    rel = cmd.islower()
+    for i in range(0, len(args), n):
+      c = args[i:i+n]
+      if rel:
+        c = [ c[j] + cur[j % 2] for j in range(n) ]
+      if cmd.upper() == 'M' and i == 0:
+        subpaths.append([ [c[0], c[1]], [], False ])
+      else:
+        # extra coordinate pairs after M are implicit L commands.
+        seg = 'L' if cmd.upper() == 'M' else cmd.upper()
+        subpaths[-1][1].append((seg, c))
+      cur[0], cur[1] = c[-2], c[-1]
+
+  for m in _path_token_re.finditer(path_d):
+    if m.group(1):
+      flush()
+      cmd = m.group(1)
+      args = []
+      if cmd.upper() == 'Z':
+        if not subpaths:
+          raise ValueError("Z without M in path")
+        subpaths[-1][2] = True
+        cur = list(subpaths[-1][0])
+      elif cmd.upper() != 'M' and not subpaths:
+        raise ValueError("path does not start with M")
+    else:
+      if cmd is None:
+        raise ValueError("path does not start with a command")
+      args.append(float(m.group(2)))
+  flush()
+  return subpaths
+
+
+def path_format(subpaths, fmt='%g'):
+  """ the svg path d attribute of a list of subpaths, in absolute commands. """
+  d = []
+  for start, segs, closed in subpaths:
+    d.append('M' + fmt % start[0] + ' ' + fmt % start[1])
+    for cmd, c in segs:
+      d.append(cmd + ' '.join([ fmt % v for v in c ]))
+    if closed:
+      d.append('Z')
+  return ''.join(d)
+
+
+def subpath_end(sub):
+  """ the last point of a subpath. """
+  if sub[1]:
+    return sub[1][-1][1][-2:]
+  return sub[0]
+
+
+def subpath_reverse(sub):
+  """ the same subpath, drawn in the opposite direction. """
+  start, segs, closed = sub
+  pts = [ start ] + [ c[-2:] for cmd, c in segs ]
+  rsegs = []
+  for i in range(len(segs)-1, -1, -1):
+    cmd, c = segs[i]
+    if cmd == 'C':
+      rsegs.append(('C', [ c[2], c[3], c[0], c[1], pts[i][0], pts[i][1] ]))
+    else:
+      rsegs.append(('L', [ pts[i][0], pts[i][1] ]))
+  return [ list(pts[-1]), rsegs, closed ]
+
+
+def subpath_translate(sub, dx, dy):
+  """ a copy of the subpath, moved by dx, dy. """
+  start, segs, closed = sub
+  return [ [start[0]+dx, start[1]+dy],
+           [ (cmd, [ v + (dy if j % 2 else dx) for j, v in enumerate(c) ]) for cmd, c in segs ],
+           closed ]
+
+
+def _bezier_point(pts, t):
+  """ the point at parameter t of a bezier curve with the control points pts (de Casteljau). """
+  while len(pts) > 1:
+    pts = [ (a[0] + (b[0] - a[0]) * t, a[1] + (b[1] - a[1]) * t) for a, b in zip(pts[:-1], pts[1:]) ]
+  return pts[0]
+
+
+def _bezier_halves(pts, t):
+  """ the control points of the two parts of a bezier curve, split at parameter t (de Casteljau). """
+  left, right = [ pts[0] ], [ pts[-1] ]
+  while len(pts) > 1:
+    pts = [ (a[0] + (b[0] - a[0]) * t, a[1] + (b[1] - a[1]) * t) for a, b in zip(pts[:-1], pts[1:]) ]
+    left.append(pts[0])
+    right.append(pts[-1])
+  return left, right[::-1]
+
+
+def _bezier_crossings(pts, axis, v):
+  """ the parameters t in 0 < t < 1, where coordinate axis of the line or cubic bezier curve pts equals v.
+      The curve is split where the derivative of that coordinate is zero. Then each part is
+      monotonic, crosses v at most once, and the crossing is found by bisection.
+  """
+  f = [ p[axis] - v for p in pts ]
+  if len(pts) == 2:
+    if (f[0] < 0 < f[1]) or (f[1] < 0 < f[0]):
+      return [ f[0] / (f[0] - f[1]) ]
+    return []
+  # the derivative is 3 * (qa t^2 + qb t + qc), in the power basis.
+  qa = -f[0] + 3*f[1] - 3*f[2] + f[3]
+  qb = 2 * (f[0] - 2*f[1] + f[2])
+  qc = f[1] - f[0]
+  bounds = [ 0. ]
+  if abs(qa) > 1e-12:
+    disc = qb*qb - 4*qa*qc
+    if disc > 0:
+      r = math.sqrt(disc)
+      bounds.extend(sorted([ (-qb - r) / (2*qa), (-qb + r) / (2*qa) ]))
+  elif abs(qb) > 1e-12:
+    bounds.append(-qc / qb)
+  bounds = [ t for t in bounds if 0 <= t < 1 ] + [ 1. ]
+  ts = []
+  for t0, t1 in zip(bounds[:-1], bounds[1:]):
+    f0 = _bezier_point(pts, t0)[axis] - v
+    f1 = _bezier_point(pts, t1)[axis] - v
+    if not ((f0 < 0 < f1) or (f1 < 0 < f0)):
+      continue
+    lo, hi = t0, t1
+    for n in range(40):
+      mid = 0.5 * (lo + hi)
+      if (_bezier_point(pts, mid)[axis] - v < 0) == (f0 < 0):
+        lo = mid
+      else:
+        hi = mid
+    ts.append(0.5 * (lo + hi))
+  return ts
+
+
+def subpath_cut(sub, xs=(), ys=()):
+  """ a copy of the subpath, where every segment that crosses one of the vertical lines x = xs[i]
+      or the horizontal lines y = ys[i] is split there. The new points lie exactly on the lines.
+      A closed subpath gets an explicit closing line, so that this is cut too.
+  """
+  start, segs, closed = sub
+  if closed and segs:
+    last = subpath_end(sub)
+    if last[0] != start[0] or last[1] != start[1]:
+      segs = segs + [ ('L', list(start)) ]
+  out = []
+  p = (start[0], start[1])
+  for cmd, c in segs:
+    if cmd == 'L':
+      pts = [ p, (c[0], c[1]) ]
+    else:
+      pts = [ p, (c[0], c[1]), (c[2], c[3]), (c[4], c[5]) ]
+    cuts = []
+    for axis, lines in ((0, xs), (1, ys)):
+      for v in lines:
+        cuts.extend([ (t, axis, v) for t in _bezier_crossings(pts, axis, v) ])
+    cuts.sort()
+    done = 0.
+    for t, axis, v in cuts:
+      if t <= done:
+        continue
+      left, pts = _bezier_halves(pts, (t - done) / (1. - done))
+      q = list(left[-1])
+      q[axis] = v
+      left[-1] = pts[0] = tuple(q)
+      out.append((cmd, [ k for pt in left[1:] for k in pt ]))
+      done = t
+    out.append((cmd, [ k for pt in pts[1:] for k in pt ]))
+    p = pts[-1]
+  return [ list(start), out, closed ]
+
+
+def subpath_split(sub, keep):
+  """ split a subpath into the runs of segments where keep(x0, y0, x1, y1) is true for
+      the straight line from the start to the end of the segment. Returns a list of subpaths.
+      A closed subpath that is kept entirely stays closed.
+  """
+  start, segs, closed = sub
+  if not segs:
+    return [ sub ] if keep(start[0], start[1], start[0], start[1]) else []
+  if closed:
+    last = subpath_end(sub)
+    if last[0] != start[0] or last[1] != start[1]:
+      segs = segs + [ ('L', list(start)) ]
+  runs = []
+  run = None
+  p = start
+  for cmd, c in segs:
+    q = c[-2:]
+    if keep(p[0], p[1], q[0], q[1]):
+      if run is None:
+        run = [ list(p), [], False ]
+        runs.append(run)
+      run[1].append((cmd, c))
+    else:
+      run = None
+    p = q
+  if closed and len(runs) == 1 and len(runs[0][1]) == len(segs):
+    return [ sub ]
+  return runs
+
+
+def subpaths_join(subpaths, tolerance, is_end=None, joins=None):
+  """ join open subpaths whose end points are closer than tolerance.
+      If is_end(x, y) is given, only end points for which it returns true are considered.
+      If joins is a list, the two end points of each join are appended to it as (x0, y0, x1, y1).
+      A short line is inserted where the end points do not match exactly.
+      End points are found through a grid with cells of size tolerance, so that
+      this scales to many subpaths. Returns a new list of subpaths.
+  """
+  if tolerance <= 0:
+    return subpaths
+  subs = [ [ list(s[0]), list(s[1]), s[2] ] for s in subpaths ]
+  cell = float(tolerance)
+  grid = {}
+  ends = []     # (x, y, subpath index, 0 for start or 1 for end)
+
+  for i, s in enumerate(subs):
+    if s[2] or not s[1]:
+      continue
+    for which, p in ((0, s[0]), (1, subpath_end(s))):
+      if is_end is not None and not is_end(p[0], p[1]):
+        continue
+      e = len(ends)
+      ends.append((p[0], p[1], i, which))
+      grid.setdefault((int(math.floor(p[0]/cell)), int(math.floor(p[1]/cell))), []).append(e)
+
+  # all candidate pairs, closest first.
+  pairs = []
+  for e, (x, y, i, which) in enumerate(ends):
+    gx, gy = int(math.floor(x/cell)), int(math.floor(y/cell))
+    for cx in (gx-1, gx, gx+1):
+      for cy in (gy-1, gy, gy+1):
+        for f in grid.get((cx, cy), ()):
+          if f <= e or ends[f][2] == i:
+            continue
+          d = math.hypot(ends[f][0] - x, ends[f][1] - y)
+          if d <= tolerance:
+            pairs.append((d, e, f))
+  pairs.sort()
+
+  # union the chains. Each subpath ends up with at most one partner on each end.
+  partner = {}
+  parent = range(len(subs))
+  def find(i):
+    while parent[i] != i:
+      parent[i] = parent[parent[i]]
+      i = parent[i]
+    return i
+  for d, e, f in pairs:
+    ke = (ends[e][2], ends[e][3])
+    kf = (ends[f][2], ends[f][3])
+    if ke in partner or kf in partner:
+      continue
+    if find(ke[0]) == find(kf[0]):
+      continue                    # would close a ring. Leave it open.
+    partner[ke] = kf
+    partner[kf] = ke
+    parent[find(ke[0])] = find(kf[0])
+    if joins is not None:
+      joins.append((ends[e][0], ends[e][1], ends[f][0], ends[f][1]))
+
+  result = []
+  done = set()
+  for i in range(len(subs)):
+    if i in done:
+      continue
+    if (i, 0) in partner and (i, 1) in partner:
+      continue                    # in the middle of a chain, it is picked up from one of its ends.
+    done.add(i)
+    if (i, 0) in partner:
+      cur = subpath_reverse(subs[i])
+      nxt = partner[(i, 0)]
+    else:
+      cur = subs[i]
+      nxt = partner.get((i, 1))
+    while nxt is not None:
+      j, which = nxt
+      done.add(j)
+      s = subs[j] if which == 0 else subpath_reverse(subs[j])
+      e = subpath_end(cur)
+      if e[0] != s[0][0] or e[1] != s[0][1]:
+        cur[1].append(('L', list(s[0])))
+      cur[1].extend(s[1])
+      nxt = partner.get((j, 1 - which))
+    result.append(cur)
+  return result
+
+
+def path_travel(subpaths, start=(0., 0.)):
+  """ the total length of the pen-up moves: from start to the first subpath, and from the end
+      of each subpath to the start of the next.
+  """
+  x, y = start
+  travel = 0.
+  for sub in subpaths:
+    travel += math.hypot(sub[0][0] - x, sub[0][1] - y)
+    x, y = sub[0] if sub[2] else subpath_end(sub)
+  return travel
+
+
+def subpaths_order(subpaths, start=(0., 0.)):
+  """ the subpaths in an order that keeps the pen-up moves short: starting at start, the
+      pen always goes to the nearest end point of a subpath that is not drawn yet. Open subpaths
+      are reversed when their end is nearer than their start.
+      End points are found through a grid with about one subpath per cell, searched in rings
+      around the pen, so that this scales to many subpaths. Returns a new list of subpaths.
+  """
+  n = len(subpaths)
+  if not n:
+    return []
+  ends = []     # (x, y, subpath index, True if the subpath is drawn reversed)
+  for i, sub in enumerate(subpaths):
+    ends.append((sub[0][0], sub[0][1], i, False))
+    e = subpath_end(sub)
+    if not sub[2] and (e[0] != sub[0][0] or e[1] != sub[0][1]):
+      ends.append((e[0], e[1], i, True))
+  x0 = min([ e[0] for e in ends ])
+  y0 = min([ e[1] for e in ends ])
+  w = max([ e[0] for e in ends ]) - x0
+  h = max([ e[1] for e in ends ]) - y0
+  cell = math.sqrt(max(w * h, w * w / n, h * h / n, 1e-12) / n)
+  grid = {}
+  for k, e in enumerate(ends):
+    grid.setdefault((int(math.floor((e[0]-x0)/cell)), int(math.floor((e[1]-y0)/cell))), []).append(k)
+
+  result = []
+  x, y = start
+  while grid:
+    gx, gy = int(math.floor((x-x0)/cell)), int(math.floor((y-y0)/cell))
+    best = None
+    r = 0
+    while True:
+      if (2*r+1)*(2*r+1) >= len(grid):
+        cells = list(grid.keys())         # fewer occupied cells than in the rings: check them all.
+      elif r == 0:
+        cells = [ (gx, gy) ]
+      else:
+        cells = [ (cx, cy) for cx in range(gx-r, gx+r+1) for cy in (gy-r, gy+r) ] + \
+                [ (cx, cy) for cx in (gx-r, gx+r) for cy in range(gy-r+1, gy+r) ]
+      for c in cells:
+        for k in grid.get(c, ()):
+          d = (ends[k][0]-x)*(ends[k][0]-x) + (ends[k][1]-y)*(ends[k][1]-y)
+          if best is None or (d, k) < best:
+            best = (d, k)
+      if (2*r+1)*(2*r+1) >= len(grid):
+        break
+      # all end points outside of the rings so far are farther away than r cells.
+      if best is not None and best[0] <= (r*cell)*(r*cell):
+        break
+      r += 1
+
+    i, rev = ends[best[1]][2:]
+    sub = subpaths[i]
+    # remove both end points of subpath i from the grid.
+    for e in (sub[0], subpath_end(sub)):
+      c = (int(math.floor((e[0]-x0)/cell)), int(math.floor((e[1]-y0)/cell)))
+      lst = grid.get(c)
+      if lst is None:
+        continue
+      lst[:] = [ k for k in lst if ends[k][2] != i ]
+      if not lst:
+        del grid[c]
+    if rev:
+      sub = subpath_reverse(sub)
+    result.append(sub)
+    x, y = sub[0] if sub[2] else subpath_end(sub)
+  return result
+
+
+def _seg_dist2(px, py, ax, ay, bx, by):
+  """ the squared distance of the point p from the line segment from a to b. """
+  dx = bx - ax
+  dy = by - ay
+  ll = dx*dx + dy*dy
+  if ll > 0:
+    t = ((px - ax)*dx + (py - ay)*dy) / ll
+    if t > 1:
+      ax, ay = bx, by
+    elif t > 0:
+      ax += t*dx
+      ay += t*dy
+  return (px - ax)*(px - ax) + (py - ay)*(py - ay)
+
+
+def subpath_simplify(sub, tolerance):
+  """ a copy of the subpath with fewer segments. Curves whose control points are within
+      tolerance of their chord become lines. A run of lines becomes one line, as long as
+      no corner of the run is farther than tolerance from it. Zero length lines are dropped,
+      except if the subpath is nothing else: that is a dot, with round line caps.
+  """
+  start, segs, closed = sub
+  tol2 = float(tolerance) * tolerance
+  out = []
+  anchor = start        # start of the pending run of lines
+  run = []              # end points of the pending lines
+  for cmd, c in segs:
+    p = run[-1] if run else anchor
+    if cmd == 'C' and _seg_dist2(c[0], c[1], p[0], p[1], c[4], c[5]) <= tol2 \
+                  and _seg_dist2(c[2], c[3], p[0], p[1], c[4], c[5]) <= tol2:
+      cmd, c = 'L', c[4:]
+    if cmd == 'L':
+      if c[0] == p[0] and c[1] == p[1]:
+        continue
+      for r in run:
+        if _seg_dist2(r[0], r[1], anchor[0], anchor[1], c[0], c[1]) > tol2:
+          out.append(('L', run[-1]))
+          anchor = run[-1]
+          run = []
+          break
+      run.append(c)
+    else:
+      if run:
+        out.append(('L', run[-1]))
+        run = []
+      out.append((cmd, c))
+      anchor = c[-2:]
+  if run:
+    out.append(('L', run[-1]))
+  if segs and not out:
+    out.append(('L', list(start)))
+  return [ list(start), out, closed ]
+
+
+def _compact_num(n, precision):
+  """ the shortest decimal string of the integer n / 10**precision. """
+  if precision <= 0:
+    return str(n)
+  s = '%0*d' % (precision + 1, abs(n))
+  i = s[:-precision].lstrip('0')
+  f = s[-precision:].rstrip('0')
+  if f:
+    i += '.' + f
+  if not i:
+    return '0'
+  return '-' + i if n < 0 else i
+
+
+def path_format_compact(subpaths, precision=2):
+  """ the svg path d attribute of a list of subpaths, as short as possible:
+      coordinates rounded to precision decimals, relative m, l, c and z commands,
+      a command letter only where the command changes, and no separator where a
+      minus sign or a decimal point separates the numbers anyway.
+      The rounding errors do not add up, as the relative coordinates are differences
+      of the rounded absolute coordinates. Subpaths without segments draw nothing and
+      are dropped. Subpaths that shrink to a point in the rounding stay as dots.
+  """
+  scale = 10 ** precision
+  out = []
+  state = { 'last': None, 'num': None }   # last command letter, last number string
+
+  def emit(cmd, values):
+    if cmd == 'm' or (cmd != state['last'] and not (cmd == 'l' and state['last'] == 'm')):
+      out.append(cmd)
+      state['num'] = None
+    state['last'] = cmd
+    for v in values:
+      s = _compact_num(v, precision)
+      prev = state['num']
+      if prev is not None and s[0] != '-' and not (s[0] == '.' and '.' in prev):
+        out.append(' ')
+      out.append(s)
+      state['num'] = s
+
+  cx = cy = 0
+  for start, segs, closed in subpaths:
+    if not segs:
+      continue
+    sx = int(round(start[0] * scale))
+    sy = int(round(start[1] * scale))
+    qsegs = []
+    px, py = sx, sy
+    for cmd, c in segs:
+      q = [ int(round(v * scale)) for v in c ]
+      if q[-2] == px and q[-1] == py and (cmd == 'L' or q[:4] == [ px, py, px, py ]):
+        continue          # vanished in the rounding.
+      qsegs.append((cmd, q))
+      px, py = q[-2], q[-1]
+    if closed:
+      while len(qsegs) > 1 and qsegs[-1][0] == 'L' and qsegs[-1][1] == [ sx, sy ]:
+        qsegs.pop()       # z draws this line anyway.
+    if not qsegs:
+      qsegs.append(('L', [ sx, sy ]))
+    emit('m', (sx - cx, sy - cy))
+    cx, cy = sx, sy
+    for cmd, q in qsegs:
+      emit(cmd.lower(), [ v - (cy if j % 2 else cx) for j, v in enumerate(q) ])
+      cx, cy = q[-2], q[-1]
+    if closed:
+      emit('z', ())
+      cx, cy = sx, sy
+  return ''.join(out)
@@ -0,0 +1,325 @@
+#
+# Centerline tracing without autotrace: thinning, skeleton graph, bezier fitting.
+# (C) 2016-2019 juewei@fabmail.org and contributors.
+# Distribute under GPL-2.0 or ask.
+#
+# This is the 'python' backend of centerline-trace.py. It produces the same
+# svg structure as 'autotrace --centerline --output-format=svg': one <path>
+# element with absolute M, L, C and Z commands in pixel coordinates.
+#
+# Algorithm:
+#
+# - The bitmap is thinned to a one pixel wide 8-connected skeleton with the
+#   Zhang-Suen algorithm. Both subiterations work on entire numpy arrays.
+#   Staircase pixels that Zhang-Suen leaves behind are removed afterwards, so
+#   that they do not show up as junctions.
+# - Skeleton pixels with exactly two neighbours are chain pixels, all others
+#   (endpoints and junctions) are nodes. Adjacent junction pixels are merged
+#   into one junction. Chains are walked from node to node, short spurs are
+#   dropped. Rings without any node become closed subpaths.
+# - Each chain is smoothed filter_iterations times, then fitted with straight
+#   lines or cubic bezier curves (Schneider, Graphics Gems 1990), subdividing
+#   where a point is further than error_threshold pixels from the curve.
+#
+# Requires: numpy
+#
+
+import numpy
+
+# neighbour offsets (dy, dx) in Zhang-Suen order P2 .. P9, starting north, clockwise.
+_nb8 = [ (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1) ]
+
+
+def _neighbours(a):
+  """ list of 8 arrays with the neighbours P2..P9 of every interior pixel of a. """
+  h, w = a.shape
+  return [ a[1+dy:h-1+dy, 1+dx:w-1+dx] for dy, dx in _nb8 ]
+
+
+def thin(dark):
+  """ Zhang-Suen thinning of a boolean array. Returns a new array. """
+  sk = numpy.zeros((dark.shape[0]+2, dark.shape[1]+2), dtype=numpy.uint8)
+  sk[1:-1,1:-1] = dark
+  inner = sk[1:-1,1:-1]
+  changed = True
+  while changed:
+    changed = False
+    for step in (0, 1):
+      p = _neighbours(sk)
+      p2, p3, p4, p5, p6, p7, p8, p9 = p
+      b = p2 + p3 + p4 + p5 + p6 + p7 + p8 + p9
+      a = numpy.zeros(inner.shape, dtype=numpy.uint8)
+      for n in range(8):
+        a += (p[n] == 0) & (p[(n+1) % 8] == 1)
+      if step == 0:
+        c = (p2 * p4 * p6 == 0) & (p4 * p6 * p8 == 0)
+      else:
+        c = (p2 * p4 * p8 == 0) & (p2 * p6 * p8 == 0)
+      rm = (inner == 1) & (b >= 2) & (b <= 6) & (a == 1) & c
+      if rm.any():
+        inner[rm] = 0
+        changed = True
+
+  # staircase cleanup: a corner pixel with two orthogonal neighbours, where the
+  # opposite side is empty, is redundant in an 8-connected skeleton.
+  for n, e, s, w, sw in ((0, 2, 4, 6, 5), (2, 4, 6, 0, 7), (4, 6, 0, 2, 1), (6, 0, 2, 4, 3)):
+    p = _neighbours(sk)
+    rm = (inner == 1) & (p[n] == 1) & (p[e] == 1) & (p[s] == 0) & (p[w] == 0) & (p[sw] == 0)
+    inner[rm] = 0
+  return inner.astype(bool)
+
+
+def skeleton_chains(sk, spur=3):
+  """ split a skeleton into chains of pixel coordinates.
+      Adjacent junction pixels are merged into one junction, and chains that meet there
+      start or end at its centroid. Spurs of up to spur pixels between an end point and
+      a junction are dropped.
+      Returns a list of (points, closed), where points is an (n,2) float array of x,y.
+  """
+  h, w = sk.shape
+  ys, xs = numpy.nonzero(sk)
+  n = len(ys)
+  if not n:
+    return []
+  idx = -numpy.ones((h+2, w+2), dtype=numpy.int64)
+  idx[ys+1, xs+1] = numpy.arange(n)
+  nb = numpy.empty((n, 8), dtype=numpy.int64)
+  for k, (dy, dx) in enumerate(_nb8):
+    nb[:,k] = idx[ys+1+dy, xs+1+dx]
+  deg = (nb >= 0).sum(axis=1)
+  neighbours = [ [ v for v in row if v >= 0 ] for row in nb.tolist() ]
+  is_node = (deg != 2).tolist()
+
+  # junctions: union-find over adjacent junction pixels.
+  junction = {}
+  def find(u):
+    while junction[u] != u:
+      junction[u] = junction[junction[u]]
+      u = junction[u]
+    return u
+  for u in numpy.nonzero(deg > 2)[0].tolist():
+    junction[u] = u
+  for u in list(junction):
+    for v in neighbours[u]:
+      if v in junction:
+        junction[find(u)] = find(v)
+  members = {}
+  for u in junction:
+    members.setdefault(find(u), []).append(u)
+  xy = numpy.column_stack((xs, ys)).astype(numpy.float64)
+  centroid = {}
+  for r, m in members.items():
+    centroid[r] = xy[m].mean(axis=0)
+
+  chains = []
+  used = set()          # visited edges (u, v) with u < v
+  seen = numpy.zeros(n, dtype=bool)
+
+  def walk(u, v):
+    chain = [u, v]
+    used.add((min(u, v), max(u, v)))
+    prev = u
+    while not is_node[v]:
+      nxt = None
+      for c in neighbours[v]:
+        if c != prev and (min(v, c), max(v, c)) not in used:
+          nxt = c
+          break
+      if nxt is None:
+        break
+      used.add((min(v, nxt), max(v, nxt)))
+      prev, v = v, nxt
+      chain.append(v)
+    return chain
+
+  for u in numpy.nonzero(deg != 2)[0].tolist():
+    if deg[u] == 0:
+      chains.append(([u, u], False))          # an isolated dot
+    for v in neighbours[u]:
+      if (min(u, v), max(u, v)) in used:
+        continue
+      if u in junction and v in junction and find(u) == find(v):
+        used.add((min(u, v), max(u, v)))
+        continue
+      c = walk(u, v)
+      ju = find(c[0]) if c[0] in junction else None
+      jv = find(c[-1]) if c[-1] in junction else None
+      if len(c) <= spur + 1 and ((ju is None) != (jv is None)) and deg[c[0]] + deg[c[-1]] > 3:
+        continue                              # spur between an end point and a junction
+      if ju is not None and ju == jv and len(c) <= 3:
+        continue                              # detour inside a junction
+      chains.append((c, False))
+    seen[u] = True
+
+  # whatever is left are rings of chain pixels without any node.
+  for c, closed in chains:
+    seen[c] = True
+  for c in used:
+    seen[list(c)] = True
+  for u in numpy.nonzero(~seen)[0].tolist():
+    if seen[u]:
+      continue
+    chain = walk(u, neighbours[u][0])
+    if chain[-1] == u:
+      chain.pop()
+    seen[chain] = True
+    chains.append((chain, True))
+
+  result = []
+  for c, closed in chains:
+    pts = xy[c]
+    if c[0] in junction: pts[0] = centroid[find(c[0])]
+    if c[-1] in junction: pts[-1] = centroid[find(c[-1])]
+    result.append((pts, closed))
+  return result
+
+
+def smooth(pts, iterations, closed=False):
+  """ move each point half way towards the mean of its neighbours, iterations times.
+      The end points of open chains stay fixed, so that chains still meet at junctions.
+  """
+  pts = pts.copy()
+  if len(pts) < 3:
+    return pts
+  for i in range(iterations):
+    if closed:
+      mean = 0.5 * (numpy.roll(pts, 1, axis=0) + numpy.roll(pts, -1, axis=0))
+      pts = 0.5 * (pts + mean)
+    else:
+      pts[1:-1] = 0.5 * pts[1:-1] + 0.25 * (pts[:-2] + pts[2:])
+  return pts
+
+
+def _unit(v):
+  l = numpy.hypot(v[0], v[1])
+  if l < 1e-12:
+    return numpy.zeros(2)
+  return v / l
+
+
+def _bezier(ctrl, t):
+  t = t[:,None]
+  mt = 1 - t
+  return (mt**3) * ctrl[0] + 3 * (mt**2) * t * ctrl[1] + 3 * mt * (t**2) * ctrl[2] + (t**3) * ctrl[3]
+
+
+def _bezier_prime(ctrl, t):
+  t = t[:,None]
+  mt = 1 - t
+  return 3 * (mt**2) * (ctrl[1] - ctrl[0]) + 6 * mt * t * (ctrl[2] - ctrl[1]) + 3 * (t**2) * (ctrl[3] - ctrl[2])
+
+
+def _bezier_prime2(ctrl, t):
+  t = t[:,None]
+  return 6 * (1 - t) * (ctrl[2] - 2 * ctrl[1] + ctrl[0]) + 6 * t * (ctrl[3] - 2 * ctrl[2] + ctrl[1])
+
+
+def _chord_params(pts):
+  d = numpy.hypot(*numpy.diff(pts, axis=0).T)
+  u = numpy.concatenate(([0.], numpy.cumsum(d)))
+  if u[-1] <= 0:
+    return numpy.linspace(0, 1, len(pts))
+  return u / u[-1]
+
+
+def _generate_bezier(pts, u, t1, t2):
+  """ least squares fit of the two inner control points along the tangents t1, t2. """
+  p0, p3 = pts[0], pts[-1]
+  a1 = (3 * (1 - u)**2 * u)[:,None] * t1
+  a2 = (3 * (1 - u) * u**2)[:,None] * t2
+  c00 = (a1 * a1).sum()
+  c01 = (a1 * a2).sum()
+  c11 = (a2 * a2).sum()
+  tmp = pts - _bezier(numpy.array([p0, p0, p3, p3]), u)
+  x0 = (a1 * tmp).sum()
+  x1 = (a2 * tmp).sum()
+  det = c00 * c11 - c01 * c01
+  seg = numpy.hypot(*(p3 - p0))
+  alpha1 = alpha2 = 0.
+  if abs(det) > 1e-12:
+    alpha1 = (x0 * c11 - x1 * c01) / det
+    alpha2 = (c00 * x1 - c01 * x0) / det
+  if alpha1 < 1e-6 * seg or alpha2 < 1e-6 * seg:
+    alpha1 = alpha2 = seg / 3.
+  return numpy.array([p0, p0 + alpha1 * t1, p3 + alpha2 * t2, p3])
+
+
+def _reparameterize(ctrl, pts, u):
+  d = _bezier(ctrl, u) - pts
+  d1 = _bezier_prime(ctrl, u)
+  d2 = _bezier_prime2(ctrl, u)
+  num = (d * d1).sum(axis=1)
+  den = (d1 * d1).sum(axis=1) + (d * d2).sum(axis=1)
+  ok = numpy.abs(den) > 1e-12
+  u = u.copy()
+  u[ok] -= num[ok] / den[ok]
+  return numpy.clip(u, 0., 1.)
+
+
+def _max_error(ctrl, pts, u):
+  d = numpy.hypot(*(_bezier(ctrl, u) - pts).T)
+  i = int(numpy.argmax(d))
+  return d[i], i
+
+
+def _line_error(pts):
+  """ maximum distance of pts from the straight line through the end points. """
+  p0, p1 = pts[0], pts[-1]
+  v = p1 - p0
+  l = numpy.hypot(v[0], v[1])
+  if l < 1e-12:
+    return numpy.hypot(*(pts - p0).T).max()
+  return (numpy.abs(v[0] * (pts[:,1] - p0[1]) - v[1] * (pts[:,0] - p0[0])) / l).max()
+
+
+def fit_curve(pts, error, t1=None, t2=None, depth=0):
+  """ fit pts with lines and cubic beziers. Returns a list of ('L', p1) and ('C', c1, c2, p3) tuples. """
+  if len(pts) < 3 or _line_error(pts) <= error:
+    return [ ('L', pts[-1]) ]
+  if t1 is None: t1 = _unit(pts[min(2, len(pts)-1)] - pts[0])
+  if t2 is None: t2 = _unit(pts[max(-3, -len(pts))] - pts[-1])
+  u = _chord_params(pts)
+  ctrl = _generate_bezier(pts, u, t1, t2)
+  err, split = _max_error(ctrl, pts, u)
+  if err > error and err < 4 * error:
+    for i in range(4):
+      u = _reparameterize(ctrl, pts, u)
+      ctrl = _generate_bezier(pts, u, t1, t2)
+      err, split = _max_error(ctrl, pts, u)
+      if err <= error:
+        break
+  if err <= error or depth > 32:
+    return [ ('C', ctrl[1], ctrl[2], ctrl[3]) ]
+  split = min(max(split, 1), len(pts)-2)
+  tc = _unit(pts[split-1] - pts[split+1])
+  return fit_curve(pts[:split+1], error, t1, tc, depth+1) + fit_curve(pts[split:], error, -tc, t2, depth+1)
+
+
+def chains_path_d(chains, error_threshold, filter_iterations):
+  """ the svg path d attribute for a list of chains, as returned by skeleton_chains(). """
+  d = []
+  for pts, closed in chains:
+    pts = smooth(pts, filter_iterations, closed)
+    if closed:
+      pts = numpy.vstack((pts, pts[:1]))
+    d.append('M%g %g' % (pts[0][0], pts[0][1]))
+    for seg in fit_curve(pts, error_threshold):
+      if seg[0] == 'L':
+        d.append('L%g %g' % (seg[1][0], seg[1][1]))
+      else:
+        d.append('C%g %g %g %g %g %g' % (seg[1][0], seg[1][1], seg[2][0], seg[2][1], seg[3][0], seg[3][1]))
+    if closed:
+      d.append('Z')
+  return ''.join(d)
+
+
+def centerline_svg(dark, error_threshold=2.0, filter_iterations=4):
+  """ trace a boolean numpy array (True is a black pixel) along the centerline of its strokes.
+      Returns svg text in the format of 'autotrace --centerline --output-format=svg'.
+  """
+  chains = skeleton_chains(thin(dark))
+  d = chains_path_d(chains, error_threshold, filter_iterations)
+  svg = '<?xml version="1.0" standalone="yes"?>\n<svg width="%d" height="%d">\n' % (dark.shape[1], dark.shape[0])
+  if d:
+    svg += '<path style="stroke:#000000; fill:none;" d="%s"/>\n' % d
+  return svg + '</svg>\n'
@@ -0,0 +1,107 @@
+#
+# Timing spans for centerline-trace.py
+# (C) 2016-2019 juewei@fabmail.org and contributors.
+# Distribute under GPL-2.0 or ask.
+#
+# A span is a named interval of wall time, recorded with
+#
+#   with timing.span('resize', size=im.size):
+#     ...
+#
+# Spans may be recorded from several threads. Spans of other processes are merged
+# with extend(), they keep their pid. When timing is disabled, span() costs almost nothing.
+#
+# write() saves the spans either as json (all spans plus totals per name), or in the
+# trace event format of chrome://tracing and https://ui.perfetto.dev
+#
+
+import os, time, json, threading
+
+
+class _NoSpan(object):
+  def __enter__(self):
+    return self
+  def __exit__(self, *exc):
+    return False
+  def set(self, **args):
+    pass
+
+_no_span = _NoSpan()
+
+
+class _Span(object):
+  def __init__(self, timing, name, args):
+    self.timing = timing
+    self.name = name
+    self.args = args
+  def __enter__(self):
+    self.start = time.time()
+    return self
+  def __exit__(self, *exc):
+    self.timing.add(self.name, self.start, time.time() - self.start, self.args)
+    return False
+  def set(self, **args):
+    """ add arguments to a running span, e.g. results that are known only at its end. """
+    self.args.update(args)
+
+
+class Timing(object):
+  """ a collection of timing spans. Disabled by default. """
+  def __init__(self, enabled=False):
+    self.enabled = enabled
+    self.events = []
+    self.lock = threading.Lock()
+
+  def span(self, name, **args):
+    if not self.enabled:
+      return _no_span
+    return _Span(self, name, args)
+
+  def add(self, name, start, seconds, args=None):
+    if not self.enabled:
+      return
+    ev = { 'name': name, 'start': start, 'seconds': seconds,
+           'pid': os.getpid(), 'tid': threading.current_thread().ident, 'args': args or {} }
+    self.lock.acquire()
+    self.events.append(ev)
+    self.lock.release()
+
+  def pop_events(self):
+    """ all spans recorded so far, for sending them to another process. """
+    self.lock.acquire()
+    events, self.events = self.events, []
+    self.lock.release()
+    return events
+
+  def extend(self, events):
+    self.lock.acquire()
+    self.events.extend(events)
+    self.lock.release()
+
+  def totals(self):
+    """ a dict name -> { 'count': n, 'seconds': sum } """
+    tot = {}
+    for ev in self.events:
+      t = tot.setdefault(ev['name'], { 'count': 0, 'seconds': 0.0 })
+      t['count'] += 1
+      t['seconds'] += ev['seconds']
+    return tot
+
+  def write(self, filename, fmt='json', meta=None):
+    """ write all spans to filename. fmt is 'json' or 'chrome'.
+        strftime() escapes in filename are expanded, e.g. 'trace-%Y%m%d-%H%M%S.json'.
+    """
+    filename = time.strftime(filename)
+    events = sorted(self.events, key=lambda ev: ev['start'])
+    if fmt == 'chrome':
+      data = { 'traceEvents': [ { 'name': ev['name'], 'ph': 'X', 'cat': 'centerline-trace',
+                                  'ts': int(ev['start'] * 1000000), 'dur': int(ev['seconds'] * 1000000),
+                                  'pid': ev['pid'], 'tid': ev['tid'], 'args': ev['args'] } for ev in events ],
+               'displayTimeUnit': 'ms',
+               'otherData': meta or {} }
+    else:
+      data = { 'meta': meta or {}, 'spans': events, 'totals': self.totals() }
+    fp = open(filename, 'w')
+    json.dump(data, fp, indent=1, sort_keys=True, default=str)
+    fp.close()
+    return filename
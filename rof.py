@@ -1,4 +1,4 @@
-
+# -*- coding: utf-8 -*-
 #
 # http://de.slideshare.net/Moment_of_Revelation/programming-computer-vision-with-python-32888766
 # The ROF model has the interesting property that it ﬁnds a smoother version of
@@ -6,77 +6,161 @@
 # of the ROF model and the solution techniques are quite advanced and outside
 # the scope of this book. We’ll give a brief, simpliﬁed introduction before
 # showing how to implement a ROF solver based on an algorithm by Cham- bolle
-# [5]. 
+# [5].
 #
 # from PIL import Image
-# import pylab
+# import numpy
 # import rof
-# 
-# im = array(Image.open('empire.jpg').convert("L"))
-# U,T = rof.denoise(im,im)
+#
+# im = numpy.asarray(Image.open('empire.jpg').convert("L"))
+# U,iterations,P = rof.denoise(im)
+# U,iterations = rof.denoise_pyramid(im, tv_weight=50, time_budget=0.5)   # faster, for large images
+#
+# The solver works in place on preallocated float32 buffers, so that an iteration
+# allocates nothing. It stops at the tolerance, after max_iterations, or when
+# time_budget seconds are used up, whichever comes first.
 #
 
-from numpy import *
+import time
+import numpy
 
-def denoise(im, U_init, tolerance=0.1, tau=0.125, tv_weight=100):
+def _divergence(Qx, Qy, D):
+    """ backward differences of the dual field into D. The negative adjoint of the forward
+        differences, with a zero gradient at the last column / row (Neumann boundary).
+        Expects Qx[:,-1] and Qy[-1,:] to be zero. Then the x-differences can be taken
+        on the flat, contiguous arrays, which is much faster than on column slices.
+    """
+    qx = Qx.reshape(-1)
+    d = D.reshape(-1)
+    numpy.subtract(qx[1:], qx[:-1], out=d[1:])
+    d[0] = qx[0]
+    D[1:,:] += Qy[1:,:]
+    D[1:,:] -= Qy[:-1,:]
+    D[0,:] += Qy[0,:]
+
+def denoise(im, tolerance=0.1, tau=0.125, tv_weight=100, max_iterations=200, time_budget=None, P_init=None, check_every=4):
     """ An implementation of the Rudin-Osher-Fatemi (ROF) denoising model
         using the numerical procedure presented in Eq. (11) of A. Chambolle
-        (2005). Implemented using periodic boundary conditions 
-        (essentially turning the rectangular image domain into a torus!).
-    
+        (2005). Implemented with Neumann boundary conditions, so that
+        nothing leaks from one edge of the image to the opposite one.
+
         Input:
         im - noisy input image (grayscale)
-        U_init - initial guess for U
         tv_weight - weight of the TV-regularizing term
         tau - steplength in the Chambolle algorithm
         tolerance - tolerance for determining the stop criterion
-    
+        max_iterations - stop after this many iterations
+        time_budget - stop after this many seconds (None: no limit)
+        P_init - initial dual field (Px, Py), e.g. from a solve at lower resolution
+        check_every - test the stop criterion only every this many iterations
+
         Output:
-        U - denoised and detextured image (also the primal variable)
-        T - texture residual"""
-    
+        U - denoised and detextured image (also the primal variable).
+            The texture residual is im - U.
+        iterations - the number of iterations done
+        P - the dual field (Px, Py), for a warm start with P_init
+
+        Internally, Q = P * tv_weight / tau is iterated. With this scaling, the gradient
+        is added to Q without a multiplication, and U = im + tau * div(Q)."""
+
     #---Initialization
+    t0 = time.time()
+    im = numpy.ascontiguousarray(im, dtype=numpy.float32)
     m,n = im.shape #size of noisy image
+    if m < 2 or n < 2:
+        return im.copy(), 0, (numpy.zeros((m,n), dtype=numpy.float32), numpy.zeros((m,n), dtype=numpy.float32))
+
+    scale = numpy.float32(tv_weight/tau)
+    step = numpy.float32(tau/tv_weight)
+    tau = numpy.float32(tau)
+    one = numpy.float32(1)
+    if P_init is None:
+        Qx = numpy.zeros((m,n), dtype=numpy.float32) #x-component to the dual field
+        Qy = numpy.zeros((m,n), dtype=numpy.float32) #y-component of the dual field
+    else:
+        Qx = numpy.multiply(P_init[0], scale, dtype=numpy.float32)
+        Qy = numpy.multiply(P_init[1], scale, dtype=numpy.float32)
+        Qx[:,-1] = 0
+        Qy[-1,:] = 0
+    Norm = numpy.empty((m,n), dtype=numpy.float32)
+    Tmp = numpy.empty((m,n), dtype=numpy.float32)
+    U = numpy.empty((m,n), dtype=numpy.float32)
+    qx = Qx.reshape(-1)
+    u = U.reshape(-1)
 
-    U = U_init
-    Px = im #x-component to the dual field
-    Py = im #y-component of the dual field
-    error = 1 
+    _divergence(Qx, Qy, U)
+    U *= tau
+    U += im
     iteration = 0
 
     #---Main iteration
-    while (error > tolerance):
-        Uold = U
+    while iteration < max_iterations:
+        iteration += 1
+        check = (iteration % check_every == 0)
+        if check:
+            Uold = U.copy()
 
-        #Gradient of primal variable
-        LyU = vstack((U[1:,:],U[0,:])) #Left translation w.r.t. the y-direction
-        LxU = hstack((U[:,1:],U.take([0],axis=1))) #Left translation w.r.t. the x-direction
+        #Gradient of primal variable, added to the dual variable. Zero at the last column / row.
+        qx[:-1] += u[1:]
+        qx[:-1] -= u[:-1]
+        Qx[:,-1] = 0
+        Qy[:-1,:] += U[1:,:]
+        Qy[:-1,:] -= U[:-1,:]
 
-        GradUx = LxU-U #x-component of U's gradient
-        GradUy = LyU-U #y-component of U's gradient
-
-        #First we update the dual varible
-        PxNew = Px + (tau/tv_weight)*GradUx #Non-normalized update of x-component (dual)
-        PyNew = Py + (tau/tv_weight)*GradUy #Non-normalized update of y-component (dual)
-        NormNew = maximum(1,sqrt(PxNew**2+PyNew**2))
-
-        Px = PxNew/NormNew #Update of x-component (dual)
-        Py = PyNew/NormNew #Update of y-component (dual)
+        #Projection of the dual variable back into the disc of radius tv_weight/tau
+        numpy.multiply(Qx, Qx, out=Norm)
+        numpy.multiply(Qy, Qy, out=Tmp)
+        Norm += Tmp
+        numpy.sqrt(Norm, out=Norm)
+        Norm *= step
+        numpy.clip(Norm, one, None, out=Norm)      # max(1, Norm), but much faster than numpy.maximum()
+        Qx /= Norm
+        Qy /= Norm
 
         #Then we update the primal variable
-        RxPx =hstack((Px.take([-1],axis=1),Px[:,0:-1])) #Right x-translation of x-component
-        RyPy = vstack((Py[-1,:],Py[0:-1,:])) #Right y-translation of y-component
-        DivP = (Px-RxPx)+(Py-RyPy) #Divergence of the dual field.
-        U = im + tv_weight*DivP #Update of the primal variable
+        _divergence(Qx, Qy, U)
+        U *= tau
+        U += im
 
         #Update of error-measure
-        error = linalg.norm(U-Uold)/sqrt(n*m);
-        iteration += 1;
+        if check:
+            Uold -= U
+            error = numpy.sqrt(numpy.vdot(Uold, Uold) / (n*m))
+            if error < tolerance:
+                break
+        if time_budget is not None and time.time() - t0 > time_budget:
+            break
+
+    Qx *= step
+    Qy *= step
+    return U, iteration, (Qx, Qy)
 
-        print iteration, error
+def denoise_pyramid(im, tolerance=0.1, tau=0.125, tv_weight=100, max_iterations=200, time_budget=None, min_size=64):
+    """ ROF denoising with a warm start: the image is first solved at half the resolution
+        (recursively), and the upsampled dual field of that solution starts the iteration here.
+        At half the resolution, half the tv_weight gives the same smoothing.
+        The time_budget applies to all levels together.
+        Returns (U, iterations), the iterations at full resolution.
+    """
+    U, iterations, P = _denoise_pyramid(im, tolerance, tau, tv_weight, max_iterations, time_budget, min_size)
+    return U, iterations
 
-    #The texture residual
-    T = im - U
-    print 'Number of ROF iterations: ', iteration
-    
-    return U,T
+def _denoise_pyramid(im, tolerance, tau, tv_weight, max_iterations, time_budget, min_size):
+    """ denoise_pyramid(), that also returns the dual field for the next level: (U, iterations, P) """
+    t0 = time.time()
+    im = numpy.asarray(im, dtype=numpy.float32)
+    m,n = im.shape
+    P_init = None
+    if min(m, n) >= 2*min_size:
+        # 2x2 box mean of the even part of the image.
+        small = im[:m//2*2, :n//2*2].reshape(m//2, 2, n//2, 2).mean(axis=3).mean(axis=1)
+        budget = None if time_budget is None else time_budget * 0.5
+        U, iterations, (Px, Py) = _denoise_pyramid(small, tolerance, tau, tv_weight*0.5, max_iterations, budget, min_size)
+        P_init = []
+        for P in (Px, Py):
+            big = numpy.zeros((m,n), dtype=numpy.float32)
+            big[:m//2*2, :n//2*2] = P.repeat(2, axis=0).repeat(2, axis=1)
+            P_init.append(big)
+    if time_budget is not None:
+        time_budget = max(0.0, time_budget - (time.time() - t0))
+    return denoise(im, tolerance, tau, tv_weight, max_iterations, time_budget, P_init)
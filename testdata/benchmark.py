@@ -0,0 +1,185 @@
+#! /usr/bin/python
+#
+# Benchmark of the centerline-trace pipeline over the images in testdata.
+#
+# Usage:
+#   python testdata/benchmark.py [options] [IMAGE ...]
+#   python testdata/benchmark.py -o before.json
+#   python testdata/benchmark.py -b before.json -o after.json      # exits 1 on regressions
+#
+# For each image, the stages decode, preprocessing (each of its steps, e.g. resize, median
+# and autocontrast), threshold, trace and score are timed separately,
+# then svg_centerline_trace() end-to-end for all combinations of --candidates and
+# --megapixels. Each measurement is the best of --repeat runs, in milliseconds.
+#
+# By default autotrace is replaced by testdata/fake-autotrace.py, which replays the
+# recorded outputs in testdata/svg. Thus the results are reproducible and do not
+# depend on the installed autotrace version. Use --real-autotrace to time the real one.
+# The trace result cache is always disabled.
+#
+
+import sys, os, glob, time, imp, json, tempfile, shutil
+from optparse import OptionParser
+
+testdata = os.path.dirname(os.path.abspath(__file__))
+topdir = os.path.dirname(testdata)
+sys.path.insert(0, topdir)
+centerline_trace = imp.load_source('centerline_trace', os.path.join(topdir, 'centerline-trace.py'))
+
+
+def best_ms(fn, repeat):
+  """ the best wall time of repeat calls of fn in milliseconds, and the last result. """
+  best = None
+  for i in range(repeat):
+    t0 = time.time()
+    res = fn()
+    t = (time.time() - t0) * 1000.
+    if best is None or t < best:
+      best = t
+  return (best, res)
+
+
+def make_tracer(opts, candidates, megapixels):
+  t = centerline_trace.TraceCenterline()
+  t.options, args = t.OptionParser.parse_args([ '--cache=false',
+        '--backend=' + opts.backend, '--workers=%d' % opts.workers, '--despecle=%d' % opts.despecle,
+        '--candidates=%d' % candidates, '--megapixels=%g' % megapixels ])
+  t.apply_options()
+  return t
+
+
+def stages(opts, image_file, megapixels, candidates, results):
+  """ time the pipeline stages one by one, as svg_centerline_trace() does them.
+      The image is decoded and preprocessed by the tracer itself. Each of its timing spans
+      (decode, convert, resize, median, autocontrast, ...) is a result of its own.
+  """
+  name = os.path.basename(image_file)
+  key = '%s/mp=%g/' % (name, megapixels)
+  tracer = make_tracer(opts, candidates, megapixels)
+  tracer.timing.enabled = True
+  backend = centerline_trace.trace_backends[tracer.backend](tracer)
+
+  best = {}
+  for i in range(opts.repeat):
+    tracer.timing.pop_events()
+    im, orig_im_size, im_scale = tracer.decode_image(image_file)
+    im, im_scale, tiled, scale_limit = tracer.preprocess_image(im, im_scale)
+    spans = {}
+    for ev in tracer.timing.pop_events():
+      spans[ev['name']] = spans.get(ev['name'], 0.) + ev['seconds'] * 1000.
+    for stage, t in spans.items():
+      if stage not in best or t < best[stage]:
+        best[stage] = t
+  for stage, t in best.items():
+    results[key + stage] = t
+  tracer.timing.enabled = False
+
+  thresholds = centerline_trace.candidate_thresholds(candidates)
+
+  def threshold():
+    bws = []
+    for th in thresholds:
+      lut = [ 255 for n in range(th) ] + [ 0 for n in range(th, 256) ]
+      bws.append(im.point(lut, mode='1'))
+    return bws
+  t, bws = best_ms(threshold, opts.repeat)
+  results[key + 'threshold'] = t
+
+  scratch_dir = tempfile.mkdtemp(prefix="centerlinetrace-bench")
+  try:
+    def trace():
+      return [ backend.trace_path(bw, scratch_dir, 'bw%d' % i) for i, bw in enumerate(bws) ]
+    t, traced = best_ms(trace, opts.repeat)
+    results[key + 'trace'] = t
+  finally:
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+
+  def score():
+    for path_d, pstat in traced:
+      if pstat is None:
+        centerline_trace.svg_pathstats(path_d)
+  t, dummy = best_ms(score, opts.repeat)
+  results[key + 'score'] = t
+
+
+def end_to_end(opts, image_file, megapixels, candidates, results):
+  tracer = make_tracer(opts, candidates, megapixels)
+  t, res = best_ms(lambda: tracer.svg_centerline_trace(image_file), opts.repeat)
+  results['%s/mp=%g/c=%d/total' % (os.path.basename(image_file), megapixels, candidates)] = t
+
+
+def compare(results, baseline, tolerance, min_ms):
+  """ print the results next to the baseline. Returns the list of regressed keys. """
+  regressions = []
+  for key in sorted(results):
+    t = results[key]
+    old = baseline.get(key)
+    if old is None:
+      print "%-44s %10.1f ms" % (key, t)
+      continue
+    flag = ''
+    if t > old * (1. + tolerance) and t - old > min_ms:
+      flag = '  REGRESSION'
+      regressions.append(key)
+    print "%-44s %10.1f ms %10.1f ms %6.2fx%s" % (key, t, old, t / max(old, 0.001), flag)
+  return regressions
+
+
+def main(argv):
+  parser = OptionParser(usage="%prog [options] [IMAGE ...]")
+  parser.add_option('-o', '--output', help="Write the results to this json file.")
+  parser.add_option('-b', '--baseline', help="Compare with the results in this json file. Exit 1 on regressions.")
+  parser.add_option('-t', '--tolerance', type='float', default=0.25,
+        help="Allowed slowdown against the baseline, as a fraction. (Default: 0.25)")
+  parser.add_option('--min-ms', type='float', default=5.0,
+        help="Ignore slowdowns of less than this many milliseconds. (Default: 5)")
+  parser.add_option('-r', '--repeat', type='int', default=3, help="Runs per measurement, the best counts. (Default: 3)")
+  parser.add_option('-c', '--candidates', default='1,5,15', help="Comma separated candidate counts. (Default: 1,5,15)")
+  parser.add_option('-m', '--megapixels', default='0.5,2', help="Comma separated megapixel limits. (Default: 0.5,2)")
+  parser.add_option('-j', '--workers', type='int', default=1, help="Parallel candidate runs. (Default: 1)")
+  parser.add_option('--backend', default='autotrace', help="Tracing backend. (Default: autotrace)")
+  parser.add_option('-d', '--despecle', type='int', default=3, help="Median filter size, 0 for none. (Default: 3)")
+  parser.add_option('--real-autotrace', action='store_true', default=False,
+        help="Run the installed autotrace instead of testdata/fake-autotrace.py")
+  opts, args = parser.parse_args(argv)
+
+  if not opts.real_autotrace:
+    centerline_trace.autotrace_exe = os.path.join(testdata, 'fake-autotrace.py')
+  centerline_trace.lazy_imports()
+  images = args or sorted(glob.glob(os.path.join(testdata, '*.png')) + glob.glob(os.path.join(testdata, '*.jpg')))
+  candidates = [ int(c) for c in opts.candidates.split(',') ]
+  megapixels = [ float(m) for m in opts.megapixels.split(',') ]
+
+  results = {}
+  t0 = time.time()
+  for image_file in images:
+    for mp in megapixels:
+      stages(opts, image_file, mp, max(candidates), results)
+      for c in candidates:
+        end_to_end(opts, image_file, mp, c, results)
+    print >>sys.stderr, "%s done" % os.path.basename(image_file)
+
+  baseline = {}
+  if opts.baseline:
+    baseline = json.load(open(opts.baseline))['results']
+  regressions = compare(results, baseline, opts.tolerance, opts.min_ms)
+  print "%d measurements in %.1fs" % (len(results), time.time() - t0)
+
+  if opts.output:
+    fp = open(opts.output, 'w')
+    json.dump({ 'version': centerline_trace.__version__,
+                'python': sys.version.split()[0],
+                'autotrace': 'real' if opts.real_autotrace else 'fake',
+                'backend': opts.backend,
+                'repeat': opts.repeat,
+                'results': results }, fp, indent=1, sort_keys=True)
+    fp.close()
+
+  if regressions:
+    print "%d regressions, more than %d%% slower than %s" % (len(regressions), opts.tolerance * 100, opts.baseline)
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,83 @@
+#! /usr/bin/python
+#
+# Check that tracing in tiles does not break lines at the tile seams.
+#
+# Usage:
+#   python testdata/check-tiles.py [options] [IMAGE ...]
+#
+# Each image is traced twice at full resolution and at the same threshold (one candidate):
+# once in one piece, and once in tiles of --megapixels. A line that is cut at a seam and not
+# joined again shows up as an extra subpath, two strokes joined by mistake as a missing one.
+# The check fails (exit 1), if the subpath counts differ by more than --tolerance of the
+# untiled count, plus --slack. It also fails, if a join of the tiled trace has an end point
+# that is not on a seam, or ends farther apart than the join distance of the tracer.
+#
+# The built-in python backend is used by default, so that no autotrace binary is needed.
+#
+
+import sys, os, glob, imp, math
+from optparse import OptionParser
+
+testdata = os.path.dirname(os.path.abspath(__file__))
+topdir = os.path.dirname(testdata)
+sys.path.insert(0, topdir)
+centerline_trace = imp.load_source('centerline_trace', os.path.join(topdir, 'centerline-trace.py'))
+import centerline_paths
+
+
+def subpath_count(opts, image_file, tiles):
+  """ the number of subpaths of the trace, and the joins at the seams that are wrong. """
+  t = centerline_trace.TraceCenterline()
+  t.options, args = t.OptionParser.parse_args([ '--cache=false', '--backend=' + opts.backend, '--candidates=1',
+        '--tiles=%s' % ('true' if tiles else 'false'), '--megapixels=%g' % (opts.megapixels if tiles else 1000) ])
+  t.apply_options()
+
+  # record the joins of trace_tiles().
+  recorded = []
+  subpaths_join = centerline_paths.subpaths_join
+  def recording_join(subpaths, tolerance, is_end=None, joins=None):
+    return subpaths_join(subpaths, tolerance, is_end, recorded)
+  centerline_paths.subpaths_join = recording_join
+  try:
+    path_d, stroke_width, im_size = t.svg_centerline_trace(image_file)
+  finally:
+    centerline_paths.subpaths_join = subpaths_join
+
+  tile = t.tile_size()
+  def on_seam(x, y):
+    return x % tile == 0 or y % tile == 0
+  bad = [ j for j in recorded if not (on_seam(j[0], j[1]) and on_seam(j[2], j[3]) and
+                                   math.hypot(j[2] - j[0], j[3] - j[1]) <= t.tile_join) ]
+  return len(centerline_paths.path_parse(path_d)), bad
+
+
+def main(argv):
+  parser = OptionParser(usage="%prog [options] [IMAGE ...]")
+  parser.add_option('-m', '--megapixels', type='float', default=0.05, help="Tile size in megapixels. (Default: 0.05)")
+  parser.add_option('-t', '--tolerance', type='float', default=0.1,
+        help="Allowed difference of the subpath counts, as a fraction of the untiled count. (Default: 0.1)")
+  parser.add_option('--slack', type='int', default=2, help="Allowed difference of the subpath counts on top of --tolerance. (Default: 2)")
+  parser.add_option('--backend', default='python', help="Tracing backend. (Default: python)")
+  opts, args = parser.parse_args(argv)
+
+  centerline_trace.lazy_imports()
+  images = args or sorted(glob.glob(os.path.join(testdata, '*.png')) + glob.glob(os.path.join(testdata, '*.jpg')))
+  failed = 0
+  for image_file in images:
+    whole, dummy = subpath_count(opts, image_file, False)
+    tiled, bad = subpath_count(opts, image_file, True)
+    flag = ''
+    if abs(tiled - whole) > whole * opts.tolerance + opts.slack or bad:
+      flag = '  FAILED'
+      failed += 1
+    print "%-28s %7d subpaths, %7d in tiles%s" % (os.path.basename(image_file), whole, tiled, flag)
+    for j in bad[:5]:
+      print "  wrong join (%g, %g) - (%g, %g)" % j
+  if failed:
+    print "%d of %d images have broken or wrongly joined lines at the tile seams" % (failed, len(images))
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+#
+# A deterministic stand-in for autotrace, for benchmarks and tests on machines
+# without the autotrace binary. It accepts the command line of centerline-trace.py,
+# reads the pbm file (or /dev/stdin), and prints one of the recorded autotrace
+# outputs in testdata/svg:
+#
+#  - the svg of testdata/pbm/<name>.pbm, if the input is exactly that bitmap,
+#  - else the svg of the pbm with the closest fraction of black pixels.
+#
+# The same input always gives the same output. The paths are in the coordinates
+# of kringel.png, so only the timings are meaningful for other images.
+#
+# Usage (from centerline-trace.py or testdata/benchmark.py):
+#   centerline_trace.autotrace_exe = 'testdata/fake-autotrace.py'
+#
+
+import sys, os, glob
+
+testdata = os.path.dirname(os.path.abspath(__file__))
+bitcount = [ bin(i).count('1') for i in range(256) ]
+
+
+def read_pbm(data):
+  """ (width, height, raster bytes) of a P4 pbm, with comments. """
+  fields = []
+  pos = 0
+  while len(fields) < 3:
+    while data[pos:pos+1].isspace():
+      pos += 1
+    if data[pos:pos+1] == b'#':
+      pos = data.index(b'\n', pos)
+      continue
+    end = pos
+    while not data[end:end+1].isspace():
+      end += 1
+    fields.append(data[pos:end])
+    pos = end
+  if fields[0] != b'P4':
+    raise ValueError("not a P4 pbm file")
+  return (int(fields[1]), int(fields[2]), data[pos+1:])
+
+
+def black_fraction(w, h, raster):
+  return sum([ bitcount[b] for b in bytearray(raster) ]) / float(max(w * h, 1))
+
+
+def main(argv):
+  if '--version' in argv or '-version' in argv:
+    sys.stdout.write("AutoTrace version 0.40.0 (fake-autotrace.py, replays testdata/svg)\n")
+    return 0
+  infile = argv[-1]
+  if infile == '-':
+    infile = '/dev/stdin'
+  fp = open(infile, 'rb')
+  w, h, raster = read_pbm(fp.read())
+  fp.close()
+  frac = black_fraction(w, h, raster)
+
+  best = None
+  for pbm in sorted(glob.glob(os.path.join(testdata, 'pbm', '*.pbm'))):
+    fp = open(pbm, 'rb')
+    fw, fh, fraster = read_pbm(fp.read())
+    fp.close()
+    if (fw, fh, fraster) == (w, h, raster):
+      best = (-1, pbm)
+      break
+    d = abs(black_fraction(fw, fh, fraster) - frac)
+    if best is None or d < best[0]:
+      best = (d, pbm)
+  if best is None:
+    sys.stderr.write("fake-autotrace: no fixtures in " + os.path.join(testdata, 'pbm') + "\n")
+    return 1
+  svg = os.path.join(testdata, 'svg', os.path.splitext(os.path.basename(best[1]))[0] + '.svg')
+  fp = open(svg, 'r')
+  sys.stdout.write(fp.read())
+  fp.close()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,45 @@
+#! /usr/bin/python
+#
+# Measure the startup time of the centerline-trace extension, i.e. everything
+# that happens before the first image is traced: imports, option parsing,
+# the autotrace probe and reading the svg document.
+#
+# Usage:
+#   python testdata/startup-time.py [runs] [max_ms]
+#
+# Prints the best and median wall time of 'centerline-trace.py --version' and of
+# a run with an empty selection. Exits with 1 if a median exceeds max_ms.
+#
+
+import sys, os, time, subprocess, tempfile
+
+runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+max_ms = float(sys.argv[2]) if len(sys.argv) > 2 else None
+
+topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+script = os.path.join(topdir, 'centerline-trace.py')
+
+svg = tempfile.NamedTemporaryFile(suffix='.svg', delete=False)
+svg.write('<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n' +
+          '<svg xmlns="http://www.w3.org/2000/svg" width="210mm" height="297mm" viewBox="0 0 210 297"><g id="layer1"/></svg>\n')
+svg.close()
+
+def measure(args):
+  times = []
+  for i in range(runs):
+    t0 = time.time()
+    p = subprocess.Popen([sys.executable, script] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    p.communicate()
+    times.append((time.time() - t0) * 1000.)
+  times.sort()
+  return times[0], times[len(times)//2]
+
+failed = False
+for name, args in (('--version', ['--version']), ('no selection', [svg.name])):
+  best, median = measure(args)
+  print "%-14s best %7.1f ms, median %7.1f ms (%d runs)" % (name, best, median, runs)
+  if max_ms is not None and median > max_ms:
+    print "  slower than %g ms" % max_ms
+    failed = True
+os.unlink(svg.name)
+sys.exit(1 if failed else 0)